@@ -0,0 +1,139 @@
+
+import threading
+from queue import Queue
+
+import numpy as np
+from PIL import Image
+
+from .constants import PixelModes
+from .interface import EPD
+
+class FramePipeline:
+    '''
+    Prepares frames for display in a background thread: each frame is thresholded
+    to black and white, rotated into the device's orientation, compared with the
+    previous one tile by tile, and the changed area is packed at 2 bits per pixel.
+
+    Prepared frames are read with get(), which returns
+    (index, device_frame, box, packed), or None once the frames run out. box is
+    None if the frame did not change.
+
+    Parameters
+    ----------
+
+    frames : iterable of PIL.Image or 2D numpy array
+        The frames, with the dimensions of the display's frame_buf
+
+    rotate : int
+        Clockwise rotation to apply (see AutoDisplay)
+
+    prev : 2D numpy array
+        What is on the device before the first frame, in device orientation
+
+    tile_size : int
+        The size of the tiles frames are compared in. Must be a multiple of 8, since
+        areas are packed 8 pixels to a word.
+
+    threshold : int
+        Gray levels below this become black, the rest white
+
+    depth : int
+        How many frames to prepare ahead
+    '''
+
+    pixel_format = PixelModes.M_2BPP
+
+    def __init__(self, frames, rotate, prev, tile_size=32, threshold=0x80, depth=4):
+        if tile_size % 8:
+            raise ValueError('tile_size must be a multiple of 8')
+
+        self.frames = frames
+        self.rotate = rotate
+        self.prev = prev
+        self.tile_size = tile_size
+        self.threshold = threshold
+
+        self._queue = Queue(maxsize=depth)
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self):
+        '''
+        Return the next prepared frame (see class docstring)
+        '''
+        item = self._queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def stop(self):
+        '''
+        Stop preparing frames
+        '''
+        self._stop = True
+        # unblock the thread if it is waiting to put a frame
+        while not self._queue.empty():
+            self._queue.get()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            for i, frame in enumerate(self.frames):
+                if self._stop:
+                    return
+                self._queue.put(self.prepare(i, frame))
+            self._queue.put(None)
+        except Exception as e:
+            self._queue.put(e)
+
+    def prepare(self, index, frame):
+        '''
+        Prepare one frame (see class docstring)
+        '''
+        if isinstance(frame, Image.Image):
+            frame = np.asarray(frame.convert('L'))
+
+        # flatten to black or white, in the device's orientation
+        frame = np.where(frame < self.threshold, 0x00, 0xFF).astype(np.ubyte)
+        frame = np.ascontiguousarray(np.rot90(frame, k=-(self.rotate//90)))
+
+        box = self.changed_box(self.prev, frame)
+        self.prev = frame
+
+        if box is None:
+            return (index, frame, None, None)
+
+        return (index, frame, box, self.pack(frame, box))
+
+    def changed_box(self, a, b):
+        '''
+        Return the box bounding the tiles that differ between a and b, or None
+        '''
+        t = self.tile_size
+        height, width = a.shape
+        ny, nx = -(-height//t), -(-width//t)
+
+        changed = np.zeros((ny*t, nx*t), dtype=bool)
+        changed[:height, :width] = a != b
+        tiles = changed.reshape(ny, t, nx, t).any(axis=(1, 3))
+
+        rows = np.flatnonzero(tiles.any(axis=1))
+        if not rows.size:
+            return None
+        cols = np.flatnonzero(tiles.any(axis=0))
+
+        return (
+            int(cols[0])*t,
+            int(rows[0])*t,
+            min(int(cols[-1]+1)*t, width),
+            min(int(rows[-1]+1)*t, height),
+        )
+
+    @classmethod
+    def pack(cls, frame, box):
+        '''
+        Pack the part box of frame for loading onto the device
+        '''
+        region = frame[box[1]:box[3], box[0]:box[2]]
+        return EPD.pack_pixels(region.ravel(), cls.pixel_format)
@@ -0,0 +1,543 @@
+'''
+A daemon that owns the display, so that several local programs can share it.
+
+Clients connect over a Unix socket and each claims a rectangle of the display.
+Pixel data is exchanged through a memory-mapped file per client, so only small
+JSON messages (one per line) go over the socket:
+
+    {"cmd": "info"}                            -> {"ok": true, "dims": [w, h]}
+    {"cmd": "open", "box": [x0, y0, x1, y1]}   -> {"ok": true, "box": [...], "shm": path}
+    {"cmd": "update", "mode": m, "boxes": ...} -> {"ok": true}
+
+For "update", boxes (relative to the client's rectangle) says which parts changed;
+if it is null, the client's rectangle is compared with what was last displayed.
+Requests are answered as soon as the pixels have been copied into the display's
+frame buffer. Updates that arrive while the display is busy are queued, and
+overlapping or nearby ones (from any client) are combined before being sent.
+
+Run the daemon with "python -m IT8951.daemon", and use DisplayClient to talk to it.
+'''
+
+import argparse
+import json
+import mmap
+import os
+import selectors
+import socket
+import stat
+import tempfile
+import traceback
+from sys import exit
+
+import numpy as np
+from PIL import Image, ImageChops
+
+from .constants import DisplayModes
+
+DEFAULT_SOCKET = '/tmp/it8951.sock'
+
+# the values a client may pass as the mode of an update
+_MODES = {v for k, v in vars(DisplayModes).items() if not k.startswith('_')}
+
+class DisplayServer:
+    '''
+    Serve an AutoDisplay to clients connecting on a Unix socket
+
+    Parameters
+    ----------
+
+    display : AutoDisplay
+        The display to draw on
+
+    socket_path : str, optional
+        Where to create the socket
+
+    mode : int, optional
+        File permissions for the socket and the shared memory files
+
+    idle_timeout : float, optional
+        After this many seconds without requests, the display's cleanup() is called
+        (see AutoDisplay's cleanup_budget)
+
+    poll_interval : float, optional
+        How often to check whether the display is ready, while updates are queued
+
+    shm_dir : str, optional
+        Directory for the shared memory files. Defaults to /dev/shm if it exists.
+    '''
+
+    # clients sending a longer request, or not reading this many bytes of replies,
+    # are dropped
+    max_request_size = 64*1024
+    max_unsent_size = 64*1024
+
+    def __init__(self, display, socket_path=DEFAULT_SOCKET, mode=0o660, idle_timeout=1.0,
+                 poll_interval=0.01, shm_dir=None):
+        self.display = display
+        self.socket_path = socket_path
+        self.mode = mode
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+
+        if shm_dir is None and os.path.isdir('/dev/shm'):
+            shm_dir = '/dev/shm'
+        self.shm_dir = shm_dir
+
+        _claim_socket(socket_path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        os.chmod(socket_path, mode)
+        self.listener.listen()
+        self.listener.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+        self.clients = []
+
+        # queued updates, as (mode, box)
+        self.pending = []
+
+        self._running = False
+
+    def serve_forever(self):
+        '''
+        Handle requests until stop() is called
+        '''
+        self._running = True
+        while self._running:
+            self.serve_once(self.idle_timeout)
+
+    def stop(self):
+        self._running = False
+
+    def idle(self):
+        '''
+        Return whether all queued updates have been sent to the display, and it has
+        finished showing them. Like serve_once(), only call this from the thread
+        serving requests, since it talks to the display.
+        '''
+        return not self.pending and self.display.ready()
+
+    def serve_once(self, timeout=None):
+        '''
+        Wait up to timeout seconds for requests and handle them. Then, if the display
+        is ready, send it the next queued update.
+        '''
+        if self.pending:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+
+        events = self.selector.select(timeout)
+        for key, mask in events:
+            if key.fileobj is self.listener:
+                self._accept()
+            else:
+                self._handle(key.data, mask)
+
+        if self.pending:
+            if self.display.ready():
+                self._draw_next()
+        elif not events:
+            self.display.cleanup(max_areas=1)
+
+    def _draw_next(self):
+        '''
+        Send one area to the display: the first queued update, combined with any
+        others of the same mode that are close to it
+        '''
+        mode = self.pending[0][0]
+        box = self._merge_boxes([b for m, b in self.pending if m == mode])[0]
+
+        self.pending = [(m, b) for m, b in self.pending
+                        if not (m == mode and _contains(box, b))]
+
+        self.display.draw_boxes([box], mode)
+
+    def close(self):
+        for client in list(self.clients):
+            self._drop(client)
+        self.selector.close()
+        self.listener.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _accept(self):
+        sock, _ = self.listener.accept()
+        sock.setblocking(False)
+        client = _Connection(sock)
+        self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, data=client)
+
+    def _drop(self, client):
+        self.selector.unregister(client.sock)
+        client.close()
+        self.clients.remove(client)
+
+    def _handle(self, client, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush(client)
+            if mask & selectors.EVENT_READ:
+                self._read_requests(client)
+        except OSError:
+            # the client went away
+            self._drop(client)
+        except Exception:
+            # requests are checked before anything is done with them, so this is
+            # a bug; drop the client rather than let it take down the server
+            traceback.print_exc()
+            self._drop(client)
+
+    def _read_requests(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionResetError
+
+        client.inbuf += data
+        while b'\n' in client.inbuf:
+            line, client.inbuf = client.inbuf.split(b'\n', 1)
+            try:
+                reply = self._request(client, json.loads(line.decode()))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'ok': False, 'error': str(e)}
+            client.outbuf += json.dumps(reply).encode() + b'\n'
+
+        if len(client.inbuf) > self.max_request_size:
+            raise ConnectionAbortedError('request too long')
+
+        self._flush(client)
+
+    def _flush(self, client):
+        '''
+        Send as much of the client's queued replies as it will take without
+        blocking, and wait for it to be writable if any are left
+        '''
+        if client.outbuf:
+            try:
+                sent = client.sock.send(client.outbuf)
+                client.outbuf = client.outbuf[sent:]
+            except BlockingIOError:
+                pass
+
+        if len(client.outbuf) > self.max_unsent_size:
+            raise ConnectionAbortedError('client is not reading its replies')
+
+        events = selectors.EVENT_READ
+        if client.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events != client.events:
+            self.selector.modify(client.sock, events, data=client)
+            client.events = events
+
+    def _request(self, client, req):
+        if not isinstance(req, dict):
+            raise ValueError('a request must be a JSON object')
+        cmd = req['cmd']
+
+        if cmd == 'info':
+            return {'ok': True, 'dims': [self.display.width, self.display.height]}
+
+        elif cmd == 'open':
+            box = req.get('box')
+            if box is None:
+                box = (0, 0, self.display.width, self.display.height)
+            else:
+                box = _check_box(box)
+            self._open(client, box)
+            return {'ok': True, 'box': list(client.box), 'shm': client.shm_path}
+
+        elif cmd == 'update':
+            if client.box is None:
+                raise ValueError('no region open')
+            mode = req.get('mode', DisplayModes.DU)
+            if type(mode) is not int or mode not in _MODES:
+                raise ValueError('invalid display mode {!r}'.format(mode))
+
+            boxes = req.get('boxes')
+            if boxes is not None:
+                if not isinstance(boxes, list):
+                    raise ValueError('boxes must be a list')
+                boxes = [_check_box(b) for b in boxes]
+
+            for box in self._compose(client, boxes):
+                self.pending.append((mode, box))
+            return {'ok': True}
+
+        raise ValueError('unknown command {!r}'.format(cmd))
+
+    def _open(self, client, box):
+        if client.box is not None:
+            raise ValueError('region already open')
+
+        if not (0 <= box[0] < box[2] <= self.display.width and
+                0 <= box[1] < box[3] <= self.display.height):
+            raise ValueError('box is outside the display')
+
+        for other in self.clients:
+            if other.box is not None and _overlap(box, other.box):
+                raise ValueError('box overlaps another client')
+
+        fd, path = tempfile.mkstemp(prefix='it8951-', dir=self.shm_dir)
+        os.fchmod(fd, self.mode)
+        dims = (box[2]-box[0], box[3]-box[1])
+        os.ftruncate(fd, dims[0]*dims[1])
+        client.open(box, path, fd)
+        os.close(fd)
+
+    def _compose(self, client, boxes):
+        '''
+        Copy the client's pixels into the display's frame buffer, and return the
+        boxes (in frame buffer coordinates) that need to be updated
+        '''
+        x0, y0, x1, y1 = client.box
+
+        if boxes is None:
+            self.display.frame_buf.paste(Image.fromarray(client.pixels), (x0, y0))
+            if self.display.prev_frame is None:
+                return [client.box]
+
+            diff = ImageChops.difference(
+                self.display.prev_frame.crop(client.box),
+                self.display.frame_buf.crop(client.box)
+            ).getbbox()
+            if diff is None:
+                return []
+            return [(x0+diff[0], y0+diff[1], x0+diff[2], y0+diff[3])]
+
+        rtn = []
+        for bx0, by0, bx1, by1 in boxes:
+            bx0, by0 = max(bx0, 0), max(by0, 0)
+            bx1, by1 = min(bx1, x1-x0), min(by1, y1-y0)
+            if bx0 >= bx1 or by0 >= by1:
+                continue
+            part = Image.fromarray(client.pixels[by0:by1, bx0:bx1])
+            self.display.frame_buf.paste(part, (x0+bx0, y0+by0))
+            rtn.append((x0+bx0, y0+by0, x0+bx1, y0+by1))
+        return rtn
+
+    @staticmethod
+    def _merge_boxes(boxes):
+        '''
+        Merge boxes whose bounding box is not much bigger than they are, since each
+        separate area costs a waveform
+        '''
+        boxes = list(boxes)
+        merged = True
+        while merged and len(boxes) > 1:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i+1, len(boxes)):
+                    a, b = boxes[i], boxes[j]
+                    both = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    if _area(both) <= 2*(_area(a) + _area(b)):
+                        boxes[i] = both
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return boxes
+
+
+class _Connection:
+    '''
+    The server's state for one client
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b''
+        self.outbuf = b''
+        # what the server's selector waits for on sock
+        self.events = selectors.EVENT_READ
+        self.box = None
+        self.shm_path = None
+        self.pixels = None
+        self._mmap = None
+
+    def open(self, box, shm_path, fd):
+        self.box = box
+        self.shm_path = shm_path
+        self._mmap = mmap.mmap(fd, 0)
+        self.pixels = np.frombuffer(self._mmap, dtype=np.ubyte).reshape(
+            box[3]-box[1], box[2]-box[0])
+
+    def close(self):
+        self.sock.close()
+        if self._mmap is not None:
+            self.pixels = None
+            self._mmap.close()
+            os.unlink(self.shm_path)
+
+
+class DisplayClient:
+    '''
+    A connection to a DisplayServer, owning a rectangle of the display. Draw into
+    frame_buf (or write directly into pixels, which is shared with the server) and
+    call update().
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int), optional
+        The rectangle of the display to claim. Defaults to the whole display.
+
+    socket_path : str, optional
+        The server's socket
+    '''
+
+    def __init__(self, box=None, socket_path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self._file = self.sock.makefile('rb')
+
+        reply = self._request({'cmd': 'open', 'box': box})
+        self.box = tuple(reply['box'])
+        self.width = self.box[2] - self.box[0]
+        self.height = self.box[3] - self.box[1]
+
+        with open(reply['shm'], 'r+b') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0)
+        self.pixels = np.frombuffer(self._mmap, dtype=np.ubyte).reshape(self.height, self.width)
+
+        self.frame_buf = Image.new('L', (self.width, self.height), 0xFF)
+
+    def _request(self, req):
+        self.sock.sendall(json.dumps(req).encode() + b'\n')
+        reply = json.loads(self._file.readline().decode())
+        if not reply['ok']:
+            raise RuntimeError('display server: ' + reply['error'])
+        return reply
+
+    def update(self, mode=DisplayModes.DU, boxes=None, copy=True):
+        '''
+        Display the client's pixels
+
+        Parameters
+        ----------
+
+        mode : int (from constants.DisplayModes), optional
+            The display mode to use
+
+        boxes : list of (int, int, int, int), optional
+            The parts (relative to the client's rectangle) that have changed. If
+            omitted, the server compares the whole rectangle with what it last
+            displayed.
+
+        copy : bool, optional
+            Copy frame_buf (or just boxes of it) into pixels first. Pass False if
+            you wrote into pixels directly.
+        '''
+        if copy:
+            if boxes is None:
+                self.pixels[:] = np.asarray(self.frame_buf)
+            else:
+                for x0, y0, x1, y1 in boxes:
+                    self.pixels[y0:y1, x0:x1] = np.asarray(self.frame_buf.crop((x0, y0, x1, y1)))
+
+        self._request({
+            'cmd': 'update',
+            'mode': mode,
+            'boxes': None if boxes is None else [list(b) for b in boxes],
+        })
+
+    def close(self):
+        self.pixels = None
+        self._mmap.close()
+        self._file.close()
+        self.sock.close()
+
+
+def _claim_socket(socket_path):
+    '''
+    Make socket_path available to listen on, removing a socket left there by a
+    server that is no longer running. Raises RuntimeError if a server is still
+    listening there, or if something other than a socket is in the way.
+    '''
+    if not os.path.lexists(socket_path):
+        return
+
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        raise RuntimeError('{} exists and is not a socket'.format(socket_path))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            # nobody is listening: it was left behind by a server that didn't
+            # shut down cleanly
+            os.unlink(socket_path)
+            return
+
+    raise RuntimeError('a display server is already running on {}'.format(socket_path))
+
+def _check_box(box):
+    '''
+    Return box from a request as a tuple, checking that it is 4 integers
+    '''
+    if (not isinstance(box, list) or len(box) != 4 or
+            not all(type(v) is int for v in box)):
+        raise ValueError('a box must be a list of 4 integers, not {!r}'.format(box))
+    return tuple(box)
+
+def _area(box):
+    return (box[2]-box[0])*(box[3]-box[1])
+
+def _contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and b[2] <= a[2] and b[3] <= a[3]
+
+def _overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Share an IT8951 display between programs')
+    p.add_argument('-s', '--socket', default=DEFAULT_SOCKET,
+                   help='path of the Unix socket to listen on')
+    p.add_argument('--vcom', type=float, default=-2.06,
+                   help='VCOM voltage of the display')
+    p.add_argument('-r', '--rotate', type=int, default=0, choices=(0, 90, 180, 270),
+                   help='clockwise rotation of the display')
+    p.add_argument('--cleanup-budget', type=int, default=None,
+                   help='fast updates a region can have before it is redrawn cleanly '
+                        'while idle')
+    p.add_argument('--shadow', default=None,
+                   help='file in which to keep a copy of the display contents, to '
+                        'avoid a full redraw on restart')
+    p.add_argument('--clear', action='store_true',
+                   help='clear the display at startup')
+    return p.parse_args()
+
+def main():
+    from .display import AutoEPDDisplay
+
+    args = parse_args()
+
+    # check before touching the device, which a running server may be using
+    try:
+        _claim_socket(args.socket)
+    except RuntimeError as e:
+        exit(str(e))
+
+    display = AutoEPDDisplay(
+        vcom=args.vcom,
+        rotate=args.rotate,
+        cleanup_budget=args.cleanup_budget,
+        shadow_path=args.shadow,
+    )
+    if args.clear:
+        display.clear()
+
+    server = DisplayServer(display, socket_path=args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
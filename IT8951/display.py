@@ -1,8 +1,15 @@
 
 import tkinter as tk
+from random import randrange
+from time import perf_counter, sleep
+
+import numpy as np
 from PIL import Image, ImageChops, ImageTk
 
 from .constants import DisplayModes
+from .animation import FramePipeline
+from .scheduler import RefreshScheduler
+from .shadow import FrameShadow
 
 try:
     from .interface import EPD
@@ -16,20 +23,79 @@ class AutoDisplay:
 
     Updates are done by calling the update() method, which derived classes should
     implement.
+
+    Parameters
+    ----------
+
+    width, height : int
+        The dimensions of the device
+
+    rotate : int, optional
+        Clockwise rotation (0, 90, 180 or 270 degrees) applied to frame_buf on its way
+        to the device. For 90 and 270, frame_buf has its width and height swapped
+        relative to the device.
+
+    flip : bool, optional
+        Equivalent to adding 180 to rotate
+
+    track_gray : bool, optional
+        Keep track of what DU updates have changed, and redraw it at the next
+        grayscale update
+
+    shadow_path : str, optional
+        A file in which to keep a copy of what has been written to the device (see
+        FrameShadow). If it is found at startup and matches the device, the first
+        draw_partial only updates what differs from it, instead of redrawing the
+        whole display.
+
+    cleanup_budget : int, optional
+        If given, count fast (DU, A2, DU4) updates to each tile of the display, and
+        let cleanup() redraw the tiles that have had more than this many since
+        they were last drawn with a clean waveform (see RefreshScheduler)
+
+    cleanup_tile_size : int, optional
+        The size of the tiles counted for cleanup_budget
+
+    cleanup_mode : int (from constants.DisplayModes), optional
+        The waveform cleanup() redraws with
     '''
 
-    def __init__(self, width, height, flip=False, track_gray=False):
-        self.width = width
-        self.height = height
-        self.flip = flip
+    # PIL transpose operations that rotate an image clockwise by the given angle
+    _transposes = {
+        0:   None,
+        90:  Image.ROTATE_270,
+        180: Image.ROTATE_180,
+        270: Image.ROTATE_90,
+    }
 
-        self.frame_buf = Image.new('L', (width, height), 0xFF)
+    def __init__(self, width, height, rotate=0, flip=False, track_gray=False, shadow_path=None,
+                 cleanup_budget=None, cleanup_tile_size=64, cleanup_mode=DisplayModes.GC16):
+        if flip:
+            rotate = (rotate + 180) % 360
+
+        if rotate not in self._transposes:
+            raise ValueError('rotate must be one of 0, 90, 180, 270')
+
+        self.rotate = rotate
+        self.display_width = width
+        self.display_height = height
+
+        if rotate in (90, 270):
+            self.width, self.height = height, width
+        else:
+            self.width, self.height = width, height
+
+        self.frame_buf = Image.new('L', (self.width, self.height), 0xFF)
 
         # keep track of what we have updated,
         # so that we can automatically do partial updates of only the
         # relevant portions of the display
         self.prev_frame = None
 
+        # whether prev_frame was loaded from the shadow file (and so only has
+        # 4 bits of precision)
+        self._prev_from_shadow = False
+
         self.track_gray = track_gray
         if track_gray:
             # keep track of what has changed since the last grayscale update
@@ -37,30 +103,117 @@ class AutoDisplay:
             # start out with no changes
             self.gray_change_bbox = None
 
-    def _get_frame_buf(self):
+        self.refresh_scheduler = None
+        if cleanup_budget is not None:
+            self.refresh_scheduler = RefreshScheduler(
+                (width, height),
+                budget=cleanup_budget,
+                tile_size=cleanup_tile_size,
+                mode=cleanup_mode
+            )
+
+        self.shadow = None
+        if shadow_path is not None:
+            self._load_shadow(shadow_path)
+
+    def _load_shadow(self, path):
         '''
-        Return the frame buf, rotated according to flip
+        Open the shadow file at path, and if it can be trusted use it as the
+        previous frame
         '''
-        if self.flip:
-            return self.frame_buf.rotate(180)
-        else:
-            return self.frame_buf
+        self.shadow = FrameShadow(path, (self.display_width, self.display_height),
+                                  self._fingerprint())
+
+        if not self.shadow.valid:
+            return
+
+        if not self._check_shadow():
+            self.shadow.invalidate()
+            return
+
+        # the shadow is in the device's orientation, so rotate it back
+        img = Image.fromarray(self.shadow.read())
+        transpose = self._transposes[(360-self.rotate) % 360]
+        if transpose is not None:
+            img = img.transpose(transpose)
+        self.prev_frame = img
+        self._prev_from_shadow = True
+
+    def _fingerprint(self):
+        '''
+        Return information identifying the device, stored with the shadow file
+        '''
+        return {}
+
+    def _check_shadow(self):
+        '''
+        Return whether the shadow file matches what is on the device
+        '''
+        return True
+
+    def _to_device_box(self, box):
+        '''
+        Map a bounding box in frame_buf coordinates to device coordinates
+        '''
+        minx, miny, maxx, maxy = box
+        w, h = self.width, self.height
+        if self.rotate == 90:
+            return (h-maxy, minx, h-miny, maxx)
+        elif self.rotate == 180:
+            return (w-maxx, h-maxy, w-minx, h-miny)
+        elif self.rotate == 270:
+            return (miny, w-maxx, maxy, w-minx)
+        return box
+
+    def _to_frame_box(self, box):
+        '''
+        Map a bounding box in device coordinates to frame_buf coordinates
+        (the inverse of _to_device_box)
+        '''
+        minx, miny, maxx, maxy = box
+        w, h = self.width, self.height
+        if self.rotate == 90:
+            return (miny, h-maxx, maxy, h-minx)
+        elif self.rotate == 180:
+            return (w-maxx, h-maxy, w-minx, h-miny)
+        elif self.rotate == 270:
+            return (w-maxy, minx, w-miny, maxx)
+        return box
+
+    def _get_device_region(self, box, frame=None):
+        '''
+        Return the part of the frame buf (or of frame, if given) that lands on box
+        (in device coordinates), rotated into the device's orientation. Only that
+        region is transformed, so the cost is proportional to its area rather than
+        to the whole screen.
+        '''
+        if frame is None:
+            frame = self.frame_buf
+
+        buf = frame.crop(self._to_frame_box(box))
+        transpose = self._transposes[self.rotate]
+        if transpose is not None:
+            buf = buf.transpose(transpose)
+        return buf
 
     def draw_full(self, mode):
         '''
         Write the full image to the device, and display it using mode
         '''
 
-        self.update(self._get_frame_buf().getdata(), (0,0), (self.width, self.height), mode)
+        dims = (self.display_width, self.display_height)
+        buf = self._get_device_region((0, 0) + dims)
+        self._send([(buf.getdata(), (0,0), dims)], mode)
 
         if self.track_gray:
             if mode == DisplayModes.DU:
-                diff_box = self._compute_diff_box(self.prev_frame, self._get_frame_buf(), round_to=4)
+                diff_box = self._compute_diff_box(self.prev_frame, self.frame_buf, round_to=4)
                 self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
             else:
                 self.gray_change_bbox = None
 
-        self.prev_frame = self._get_frame_buf().copy()
+        self.prev_frame = self.frame_buf.copy()
+        self._prev_from_shadow = False
 
     def draw_partial(self, mode):
         '''
@@ -71,33 +224,147 @@ class AutoDisplay:
         if self.prev_frame is None:  # first call since initialization
             self.draw_full(mode)
 
+        frame = self.frame_buf
+        if self._prev_from_shadow:
+            # the shadow only has 4 bits per pixel, so compare at that precision
+            frame = frame.point(lambda x: (x >> 4)*0x11)
+            self._prev_from_shadow = False
+
         # compute diff for this frame
         # TODO: should not have round_to in this class
-        diff_box = self._compute_diff_box(self.prev_frame, self._get_frame_buf(), round_to=4)
+        diff_boxes = []
+        for region in self._diff_regions():
+            if region == (0, 0, self.width, self.height):
+                box = self._compute_diff_box(self.prev_frame, frame, round_to=4)
+            else:
+                box = self._compute_diff_box(self.prev_frame.crop(region),
+                                             frame.crop(region), round_to=4)
+                if box is not None:
+                    box = (box[0]+region[0], box[1]+region[1], box[2]+region[0], box[3]+region[1])
+
+            if box is not None:
+                diff_boxes.append(box)
+
+        self.prev_frame = self.frame_buf.copy()
 
+        self._draw_boxes(diff_boxes, mode)
+
+    def draw_boxes(self, boxes, mode):
+        '''
+        Write only the given boxes (minx, miny, maxx, maxy) of the frame buf, without
+        looking for changes anywhere else. This is for callers that already know what
+        they changed (see widgets.WidgetLayer); changes outside the boxes are not
+        sent, though draw_partial will still find them later.
+        '''
+        if self.prev_frame is None:  # first call since initialization
+            self.draw_full(mode)
+            return
+
+        self._draw_boxes(boxes, mode, update_prev=True)
+
+    def _draw_boxes(self, boxes, mode, update_prev=False):
+        '''
+        Write the boxes of the frame buf to the device. If update_prev is set, also
+        copy what is sent into prev_frame.
+        '''
         if self.track_gray:
-            self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
+            for box in boxes:
+                self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, box)
             # reset grayscale changes to zero
             if mode != DisplayModes.DU:
-                diff_box = self._round_bbox(self.gray_change_bbox, round_to=4)
+                if self.gray_change_bbox is None:
+                    boxes = []
+                else:
+                    boxes = [self._round_bbox(self.gray_change_bbox, round_to=4)]
                 self.gray_change_bbox = None
 
-        self.prev_frame = self._get_frame_buf().copy()
-
         # nothing to do
-        if diff_box is None:
+        if not boxes:
             return
 
-        buf = self._get_frame_buf().crop(diff_box)
+        areas = []
+        for box in boxes:
+            # the area must also be aligned in the device's own coordinates
+            device_box = self._round_bbox(self._to_device_box(box), round_to=4)
+            buf = self._get_device_region(device_box)
+
+            if update_prev:
+                frame_box = self._to_frame_box(device_box)
+                self.prev_frame.paste(self.frame_buf.crop(frame_box), frame_box[:2])
+
+            # flatten to black or white
+            if mode == DisplayModes.DU:
+                buf = buf.point(lambda x: 0x00 if x < 0xB0 else 0xFF)
+
+            xy = (device_box[0], device_box[1])
+            dims = (device_box[2]-device_box[0], device_box[3]-device_box[1])
+            areas.append((buf.getdata(), xy, dims))
+
+        self._send(areas, mode)
+
+    def cleanup(self, max_areas=None):
+        '''
+        Redraw, using cleanup_mode, the tiles that have had more than cleanup_budget
+        fast updates since they were last drawn with a clean waveform. They are
+        redrawn with what was last sent to the display, regardless of any changes to
+        frame_buf since.
+
+        This is meant to be called when the application is idle. Nothing is done
+        if the display is still busy with a previous update.
+
+        Parameters
+        ----------
+
+        max_areas : int, optional
+            Redraw at most this many areas (runs of adjacent tiles), worst first
+
+        Returns
+        -------
+
+        int
+            The number of areas redrawn
+        '''
+        if self.refresh_scheduler is None or self.prev_frame is None:
+            return 0
+
+        if not self.ready():
+            return 0
+
+        areas = []
+        for box in self.refresh_scheduler.due(max_areas):
+            buf = self._get_device_region(box, frame=self.prev_frame)
+            areas.append((buf.getdata(), box[:2], (box[2]-box[0], box[3]-box[1])))
+
+        if areas:
+            self._send(areas, self.refresh_scheduler.mode)
+
+        return len(areas)
+
+    def ready(self):
+        '''
+        Return whether the display has finished its previous updates
+        '''
+        return True
 
-        # flatten to black or white
-        if mode == DisplayModes.DU:
-            buf = buf.point(lambda x: 0x00 if x < 0xB0 else 0xFF)
+    def _send(self, areas, mode):
+        '''
+        Display areas (see update_areas), and record them in the shadow file and
+        refresh scheduler
+        '''
+        self.update_areas(areas, mode)
+        self._record(areas, mode)
 
-        xy = (diff_box[0], diff_box[1])
-        dims = (diff_box[2]-diff_box[0], diff_box[3]-diff_box[1])
+    def _record(self, areas, mode):
+        '''
+        Record areas that were displayed in the shadow file and refresh scheduler
+        '''
+        if self.refresh_scheduler is not None:
+            for _, xy, dims in areas:
+                self.refresh_scheduler.record(xy, dims, mode)
 
-        self.update(buf.getdata(), xy, dims, mode)
+        if self.shadow is not None:
+            for data, xy, dims in areas:
+                self.shadow.write(data, xy, dims)
 
     def clear(self):
         '''
@@ -159,16 +426,55 @@ class AutoDisplay:
         maxy = max(a[3], b[3])
         return (minx, miny, maxx, maxy)
 
+    def _diff_regions(self):
+        '''
+        Return the boxes (in frame_buf coordinates) in which draw_partial looks for
+        changes separately. All changes within one box are sent as a single area.
+        '''
+        return [(0, 0, self.width, self.height)]
+
+    def update_areas(self, areas, mode):
+        '''
+        Write several areas to the device and display them. areas is a list of
+        (data, xy, dims) as passed to update(). Derived classes can override this
+        to schedule the areas together.
+        '''
+        for data, xy, dims in areas:
+            self.update(data, xy, dims, mode)
+
     def update(self, data, xy, dims, mode):
+        '''
+        Write data to the device and display it. xy and dims are given in device
+        coordinates, and data is already in the device's orientation.
+        '''
         raise NotImplementedError
 
 
 class AutoEPDDisplay(AutoDisplay):
     '''
     This class initializes the EPD, and uses it to display the updates
+
+    Parameters
+    ----------
+
+    epd : EPD, optional
+        The device to use. If omitted, one is created with the given vcom.
+
+    vcom : float, optional
+        The VCOM voltage, if epd is omitted
+
+    verify_shadow : int, optional
+        When a shadow file is used (see AutoDisplay), the number of randomly chosen
+        tiles to read back from the device's memory and compare to it before
+        trusting it
+
+    Additional keyword arguments are passed to AutoDisplay.
     '''
 
-    def __init__(self, epd=None, vcom=-2.06, **kwargs):
+    # size of the tiles compared by verify_shadow
+    shadow_tile_size = 16
+
+    def __init__(self, epd=None, vcom=-2.06, verify_shadow=0, **kwargs):
 
         if epd is None:
             if EPD is None:
@@ -178,8 +484,183 @@ class AutoEPDDisplay(AutoDisplay):
 
             epd = EPD(vcom=vcom)
         self.epd = epd
+        self.verify_shadow = verify_shadow
         AutoDisplay.__init__(self, self.epd.width, self.epd.height, **kwargs)
 
+    def _fingerprint(self):
+        return {
+            'img_buf_address': self.epd.img_buf_address,
+            'firmware_version': self.epd.firmware_version,
+            'lut_version': self.epd.lut_version,
+        }
+
+    def _check_shadow(self):
+        size = self.shadow_tile_size
+        for _ in range(self.verify_shadow):
+            x = randrange(0, self.display_width-size+1, 2)
+            y = randrange(0, self.display_height-size+1)
+
+            device = self.epd.read_img_area((x, y), (size, size))
+            shadow = self.shadow.read((x, y, x+size, y+size))
+
+            # the shadow only has the top 4 bits of each pixel
+            if not np.array_equal(device >> 4, shadow >> 4):
+                return False
+
+        return True
+
+    def ready(self):
+        return self.epd.display_ready()
+
+    def play(self, frames, fps=10, clean_every=None, clean_mode=DisplayModes.GC16,
+             tile_size=32, threshold=0x80):
+        '''
+        Play a sequence of frames using the fast A2 waveform. Frames are flattened
+        to black and white, compared and packed at 2 bits per pixel in a background
+        thread, so that only changed tiles are transferred while the previous frame
+        is being displayed.
+
+        Frames that can't be shown on time are dropped; their changes are sent with
+        the next frame that is shown. Afterwards, frame_buf holds the last frame.
+
+        Parameters
+        ----------
+
+        frames : iterable of PIL.Image or 2D numpy array
+            The frames, with the same dimensions as frame_buf
+
+        fps : float, optional
+            The target frame rate
+
+        clean_every : int, optional
+            Redraw the whole display with clean_mode after this many frames, to
+            clear the ghosting A2 leaves behind
+
+        clean_mode : int (from constants.DisplayModes), optional
+            The waveform for clean redraws
+
+        tile_size : int, optional
+            The granularity (a multiple of 8) at which frames are compared
+
+        threshold : int, optional
+            Gray levels below this are shown as black, the rest as white
+
+        Returns
+        -------
+
+        dict
+            'fps': the achieved frame rate, 'shown' and 'dropped': the number of
+            frames shown and dropped, 'spi_utilization': the fraction of the time
+            spent transferring pixels, 'elapsed': the total time in seconds
+        '''
+        if self.prev_frame is None:
+            self.draw_full(DisplayModes.GC16)
+
+        full = (0, 0, self.display_width, self.display_height)
+        prev = np.asarray(self._get_device_region(full, frame=self.prev_frame))
+
+        pipeline = FramePipeline(frames, self.rotate, prev, tile_size=tile_size,
+                                 threshold=threshold)
+
+        period = 1/fps
+        shown = dropped = since_clean = 0
+        load_time = 0
+        start = None
+        frame = None
+        carry = None  # changes of dropped frames, still to be sent
+
+        try:
+            while True:
+                item = pipeline.get()
+                if item is None:
+                    break
+
+                index, frame, box, packed = item
+
+                now = perf_counter()
+                if start is None:
+                    start = now - index*period
+                due = start + index*period
+
+                if now > due + period:
+                    dropped += 1
+                    carry = self._merge_bbox(carry, box)
+                    continue
+
+                if now < due:
+                    sleep(due - now)
+
+                mode = DisplayModes.A2
+                since_clean += 1
+                if clean_every is not None and since_clean >= clean_every:
+                    mode = clean_mode
+                    box = full
+                    since_clean = 0
+
+                if carry is not None:
+                    box = self._merge_bbox(carry, box)
+                    carry = None
+
+                if box is not None:
+                    if packed is None or mode != DisplayModes.A2 or box != item[2]:
+                        packed = FramePipeline.pack(frame, box)
+                    load_time += self._play_area(frame, box, packed, mode)
+
+                shown += 1
+
+            # the last frames may have been dropped
+            if carry is not None:
+                load_time += self._play_area(frame, carry, FramePipeline.pack(frame, carry),
+                                             DisplayModes.A2)
+                dropped -= 1
+                shown += 1
+
+        finally:
+            pipeline.stop()
+
+        elapsed = perf_counter() - start if start is not None else 0
+
+        if frame is not None:
+            # leave the display in the state the last frame left it in
+            transpose = self._transposes[(360-self.rotate) % 360]
+            img = Image.fromarray(frame)
+            if transpose is not None:
+                img = img.transpose(transpose)
+            self.frame_buf.paste(img)
+            self.prev_frame = self.frame_buf.copy()
+            self._prev_from_shadow = False
+
+            if self.track_gray:
+                self.gray_change_bbox = (0, 0, self.width, self.height)
+
+        return {
+            'fps': shown/elapsed if elapsed else 0,
+            'shown': shown,
+            'dropped': dropped,
+            'spi_utilization': load_time/elapsed if elapsed else 0,
+            'elapsed': elapsed,
+        }
+
+    def _play_area(self, frame, box, packed, mode):
+        '''
+        Load the already packed area box of frame, and display it. Returns the time
+        spent loading.
+        '''
+        xy = box[:2]
+        dims = (box[2]-box[0], box[3]-box[1])
+
+        self.epd.wait_display_ready()
+
+        start = perf_counter()
+        self.epd.load_img_area(packed, xy=xy, dims=dims,
+                               pixel_format=FramePipeline.pixel_format, packed=True)
+        load_time = perf_counter() - start
+
+        self.epd.display_area(xy, dims, mode)
+        self._record([(frame[box[1]:box[3], box[0]:box[2]], xy, dims)], mode)
+
+        return load_time
+
     def update(self, data, xy, dims, mode):
 
         # send image to controller
@@ -198,17 +679,120 @@ class AutoEPDDisplay(AutoDisplay):
         )
 
 
+class MultiEPDDisplay(AutoDisplay):
+    '''
+    This class drives several EPDs (e.g. on separate chip selects of the same SPI
+    bus) as one large display. frame_buf spans all of the devices, and each update
+    is split into the parts that land on each device.
+
+    The parts are loaded in whatever order the devices become ready, so a device still
+    busy with an earlier update doesn't hold up the others.
+
+    Parameters
+    ----------
+
+    epds : list of EPD
+        The devices making up the display
+
+    offsets : list of (int, int), optional
+        The position of each device's top-left corner within the combined display
+        (before rotation). Must be multiples of 4. By default the devices are placed
+        side by side, left to right.
+
+    Additional keyword arguments are passed to AutoDisplay.
+    '''
+
+    def __init__(self, epds, offsets=None, **kwargs):
+        self.epds = list(epds)
+
+        if offsets is None:
+            offsets = []
+            x = 0
+            for epd in self.epds:
+                offsets.append((x, 0))
+                x += epd.width
+
+        if len(offsets) != len(self.epds):
+            raise ValueError('need one offset per EPD')
+
+        if any(x%4 or y%4 for x, y in offsets):
+            raise ValueError('EPD offsets must be multiples of 4')
+
+        self.offsets = [tuple(o) for o in offsets]
+
+        width = max(x+epd.width for epd, (x, _) in zip(self.epds, self.offsets))
+        height = max(y+epd.height for epd, (_, y) in zip(self.epds, self.offsets))
+        AutoDisplay.__init__(self, width, height, **kwargs)
+
+    def _split_area(self, data, xy, dims):
+        '''
+        Split an update area into pieces for each EPD it overlaps. Returns a list of
+        (epd, xy, dims, data) with xy relative to that EPD.
+        '''
+        buf = np.frombuffer(bytes(data), dtype=np.ubyte).reshape(dims[1], dims[0])
+
+        rtn = []
+        for epd, (ox, oy) in zip(self.epds, self.offsets):
+            minx = max(xy[0], ox)
+            miny = max(xy[1], oy)
+            maxx = min(xy[0]+dims[0], ox+epd.width)
+            maxy = min(xy[1]+dims[1], oy+epd.height)
+
+            if minx >= maxx or miny >= maxy:
+                continue
+
+            part = buf[miny-xy[1]:maxy-xy[1], minx-xy[0]:maxx-xy[0]]
+            rtn.append((epd, (minx-ox, miny-oy), (maxx-minx, maxy-miny), part.ravel()))
+
+        return rtn
+
+    def _diff_regions(self):
+        # look for changes on each EPD separately, so that changes on different
+        # EPDs are not merged into one box spanning all of them
+        return [self._to_frame_box((x, y, x+epd.width, y+epd.height))
+                for epd, (x, y) in zip(self.epds, self.offsets)]
+
+    def ready(self):
+        return all(epd.display_ready() for epd in self.epds)
+
+    def update(self, data, xy, dims, mode):
+        self.update_areas([(data, xy, dims)], mode)
+
+    def update_areas(self, areas, mode):
+        pending = []
+        for data, xy, dims in areas:
+            pending += self._split_area(data, xy, dims)
+
+        # rather than waiting on each EPD in turn, load whichever ones are ready
+        # and come back for the others
+        while pending:
+            waiting = []
+            for part in pending:
+                epd, part_xy, part_dims, part_data = part
+                if not epd.display_ready():
+                    waiting.append(part)
+                    continue
+
+                epd.load_img_area(part_data, xy=part_xy, dims=part_dims)
+                epd.display_area(part_xy, part_dims, mode)
+
+            if len(waiting) == len(pending):
+                sleep(0.01)
+
+            pending = waiting
+
+
 class VirtualEPDDisplay(AutoDisplay):
     '''
     This class opens a Tkinter window showing what would be displayed on the
     EPD, to allow testing without a physical e-paper device
     '''
 
-    def __init__(self, dims=(800,600)):
-        AutoDisplay.__init__(self, dims[0], dims[1])
+    def __init__(self, dims=(800,600), **kwargs):
+        AutoDisplay.__init__(self, dims[0], dims[1], **kwargs)
 
         self.root = tk.Tk()
-        self.pil_img = self.frame_buf.copy()
+        self.pil_img = Image.new('L', dims, 0xFF)
         self.tk_img = ImageTk.PhotoImage(self.pil_img)
         self.panel = tk.Label(self.root, image=self.tk_img)
         self.panel.pack(side="bottom", fill="both", expand="yes")
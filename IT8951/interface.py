@@ -1,7 +1,11 @@
 
 from . import constants
 from .constants import Commands, Registers, DisplayModes, PixelModes
-from .spi import SPI
+
+try:
+    from .spi import SPI
+except ModuleNotFoundError:
+    SPI = None
 
 from time import sleep
 from os import geteuid
@@ -19,20 +23,36 @@ class EPD:
     vcom : float
          The VCOM voltage that produces optimal display. Varies from
          device to device.
+
+    spi : SPI, optional
+         The SPI object to communicate through. Pass one to use pins other than
+         the defaults, e.g. to drive several devices on separate chip selects.
+         If omitted, one is created with the default pins.
     '''
 
-    def __init__(self, vcom=-1.5):
+    def __init__(self, vcom=-1.5, spi=None):
 
-        # check that we are root
         self.early_exit = False
-        if geteuid() != 0:
-            print("***EPD controller must be run as root!***")
-            self.early_exit = True
-            exit()
+        if spi is None:
+            if SPI is None:
+                raise RuntimeError('Problem importing SPI interface. Did you build the '
+                                   'backend with "pip install ./" or "python setup.py '
+                                   'build_ext --inplace"?')
+
+            # check that we are root
+            if geteuid() != 0:
+                print("***EPD controller must be run as root!***")
+                self.early_exit = True
+                exit()
 
-        self.spi = SPI()
+            spi = SPI()
 
-        self.spi.reset()
+        self.spi = spi
+
+        # devices sharing a reset line should only have it on one SPI object,
+        # otherwise initializing one device would reset the others
+        if self.spi.pin_reset is not None:
+            self.spi.reset()
 
         self.width            = None
         self.height           = None
@@ -51,7 +71,8 @@ class EPD:
     def __del__(self):
         pass
 
-    def load_img_area(self, buf, rotate_mode=constants.Rotate.NONE, xy=None, dims=None):
+    def load_img_area(self, buf, rotate_mode=constants.Rotate.NONE, xy=None, dims=None,
+                      pixel_format=PixelModes.M_4BPP, packed=False):
         '''
         Write the pixel data in buf (an array of bytes, 1 per pixel) to device memory.
         This function does not actually display the image (see EPD.display_area).
@@ -72,17 +93,26 @@ class EPD:
         dims : (int, int), optional
             The dimensions of the area being pasted. If xy is omitted (or set to None), the
             dimensions are assumed to be the dimensions of the display area.
+
+        pixel_format : constants.PixelModes, optional
+            The number of bits per pixel to transfer. Fewer bits make for a faster
+            transfer, at the cost of fewer gray levels. For M_2BPP, the area's width
+            should be a multiple of 8.
+
+        packed : bool, optional
+            If True, buf has already been packed into 16-bit words according to
+            pixel_format (see EPD.pack_pixels), e.g. ahead of time in another thread
         '''
 
         endian_type = constants.EndianTypes.LITTLE
-        pixel_format = constants.PixelModes.M_4BPP
 
         if xy is None:
             self._load_img_start(endian_type, pixel_format, rotate_mode)
         else:
             self._load_img_area_start(endian_type, pixel_format, rotate_mode, xy, dims)
 
-        buf = self._pack_pixels(buf, pixel_format)
+        if not packed:
+            buf = self.pack_pixels(buf, pixel_format)
         self.spi.write_pixels(buf)
 
         self._load_img_end()
@@ -103,8 +133,15 @@ class EPD:
         self.width  = data[0]
         self.height = data[1]
         self.img_buf_address = data[3] << 16 | data[2]
-        self.firmware_version = ''.join([chr(x>>8)+chr(x&0xFF) for x in data[4:12]])
-        self.lut_version      = ''.join([chr(x>>8)+chr(x&0xFF) for x in data[12:20]])
+        self.firmware_version = self._words_to_str(data[4:12])
+        self.lut_version      = self._words_to_str(data[12:20])
+
+    @staticmethod
+    def _words_to_str(words):
+        '''
+        Decode a string packed two characters per 16-bit word, high byte first
+        '''
+        return np.asarray(words, dtype=np.uint16).astype('>u2').tobytes().decode('latin-1')
 
     def get_vcom(self):
         '''
@@ -128,7 +165,7 @@ class EPD:
             raise ValueError("vcom must be between -5 and 0")
 
     @staticmethod
-    def _pack_pixels(buf, pixel_format):
+    def pack_pixels(buf, pixel_format):
         '''
         Take a buffer where each byte represents a pixel, and pack it
         into 16-bit words according to pixel_format.
@@ -170,8 +207,14 @@ class EPD:
     def sleep(self):
         self.spi.write_cmd(Commands.SLEEP)
 
+    def display_ready(self):
+        '''
+        Return whether the device has finished displaying (all LUT engines are idle)
+        '''
+        return not self.read_register(Registers.LUTAFSR)
+
     def wait_display_ready(self):
-        while(self.read_register(Registers.LUTAFSR)):
+        while not self.display_ready():
             sleep(0.01)
 
     def _load_img_start(self, endian_type, pixel_format, rotate_mode):
@@ -189,8 +232,7 @@ class EPD:
         '''
         Read a device register
         '''
-        self.spi.write_cmd(Commands.REG_RD, address)
-        return self.spi.read_int()
+        return self.spi.read_register(address)
 
     def write_register(self, address, val):
         '''
@@ -205,25 +247,57 @@ class EPD:
         self.write_register(Registers.LISAR+2, word0)
         self.write_register(Registers.LISAR, word1)
 
-    ##########
-    # the following functions are transcribed from example code from waveshare, but have not
-    # been tested
+    def read_img_area(self, xy, dims):
+        '''
+        Read pixels back from device memory, as a 2D numpy array with one byte per
+        pixel. xy[0] and dims[0] must be even.
 
-    # def mem_burst_read_trigger(self, address, count):
-    #     # these are both 32 bits, so we need to split them
-    #     # up into two 16 bit values
+        Assumes the image buffer holds one byte per pixel, row by row, and that each
+        16-bit word read holds two pixels with the first in the low byte.
+        '''
+        words = np.empty((dims[1], dims[0]//2), dtype=np.uint16)
 
-    #     addr0 = address & 0xFFFF
-    #     addr1 = address >> 16
+        if xy[0] == 0 and dims[0] == self.width:
+            # full rows are contiguous in memory, so read them all at once
+            self._mem_burst_read(self.img_buf_address + xy[1]*self.width, words.reshape(-1))
+        else:
+            for row in range(dims[1]):
+                address = self.img_buf_address + (xy[1]+row)*self.width + xy[0]
+                self._mem_burst_read(address, words[row])
 
-    #     len0 = count & 0xFFFF
-    #     len1 = count >> 16
+        return words.astype('<u2', copy=False).view(np.ubyte)
+
+    def _mem_burst_read(self, address, buf):
+        '''
+        Read len(buf) words of device memory starting at address into buf
+        '''
+        self._mem_burst_read_trigger(address, len(buf))
+        self._mem_burst_read_start()
+        self.spi.read_data_into(buf)
+        self._mem_burst_end()
+
+    def _mem_burst_read_trigger(self, address, count):
+        # these are both 32 bits, so we need to split them
+        # up into two 16 bit values
 
-    #     self.spi.write_cmd(Commands.MEM_BST_RD_T,
-    #                        addr0, addr1, len0, len1)
+        addr0 = address & 0xFFFF
+        addr1 = address >> 16
 
-    # def mem_burst_read_start(self):
-    #     self.spi.write_cmd(Commands.MEM_BST_RD_S)
+        len0 = count & 0xFFFF
+        len1 = count >> 16
+
+        self.spi.write_cmd(Commands.MEM_BST_RD_T,
+                           addr0, addr1, len0, len1)
+
+    def _mem_burst_read_start(self):
+        self.spi.write_cmd(Commands.MEM_BST_RD_S)
+
+    def _mem_burst_end(self):
+        self.spi.write_cmd(Commands.MEM_BST_END)
+
+    ##########
+    # the following functions are transcribed from example code from waveshare, but have not
+    # been tested
 
     # def mem_burst_write(self, address, count):
     #     addr0 = address & 0xFFFF
@@ -235,9 +309,6 @@ class EPD:
     #     self.spi.write_cmd(Commands.MEM_BST_WR,
     #                    addr0, addr1, len0, len1)
 
-    # def mem_burst_end(self):
-    #     self.spi.write_cmd(Commands.MEM_BST_END)
-
     # def display_area_1bpp(self, xy, dims, display_mode, background_gray, foreground_gray):
 
     #     # set display to 1bpp mode
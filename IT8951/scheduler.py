@@ -0,0 +1,105 @@
+
+import numpy as np
+
+from .constants import DisplayModes
+
+class RefreshScheduler:
+    '''
+    Keeps count, for each tile of the display, of the fast (e.g. DU or A2) updates
+    since it was last drawn with a clean waveform, and picks out the tiles that
+    have gone over budget so that only those get a clean refresh.
+
+    All coordinates are device coordinates.
+
+    Parameters
+    ----------
+
+    dims : (int, int)
+        The dimensions of the display
+
+    budget : int
+        The number of fast updates a tile can have before it is due a clean refresh
+
+    tile_size : int
+        The width and height of the tiles. Should be a multiple of 4.
+
+    mode : int (from constants.DisplayModes)
+        The waveform to use for clean refreshes
+    '''
+
+    # waveforms that leave ghosting behind
+    fast_modes = (DisplayModes.DU, DisplayModes.A2, DisplayModes.DU4)
+
+    def __init__(self, dims, budget=10, tile_size=64, mode=DisplayModes.GC16):
+        if mode in self.fast_modes:
+            raise ValueError('cleanup mode must not be a fast waveform')
+
+        self.dims = dims
+        self.budget = budget
+        self.tile_size = tile_size
+        self.mode = mode
+
+        ntiles = [-(-d//tile_size) for d in dims]  # round up
+        self.counts = np.zeros((ntiles[1], ntiles[0]), dtype=np.uint32)
+
+    def record(self, xy, dims, mode):
+        '''
+        Record an update of the area at xy with dimensions dims using mode
+        '''
+        t = self.tile_size
+        x0, y0 = xy
+        x1, y1 = x0+dims[0], y0+dims[1]
+
+        if mode in self.fast_modes:
+            # every tile the area touches
+            self.counts[y0//t:-(-y1//t), x0//t:-(-x1//t)] += 1
+        else:
+            # only tiles that are completely redrawn are clean now. tiles at the
+            # edge of the display count as complete if the area reaches the edge
+            tx1 = self.counts.shape[1] if x1 >= self.dims[0] else x1//t
+            ty1 = self.counts.shape[0] if y1 >= self.dims[1] else y1//t
+            self.counts[-(-y0//t):ty1, -(-x0//t):tx1] = 0
+
+    def due(self, max_areas=None):
+        '''
+        Return the areas that are due a clean refresh, as a list of boxes
+        (minx, miny, maxx, maxy). Tiles next to each other in a row are merged into
+        one area, and the areas with the most fast updates come first.
+
+        Parameters
+        ----------
+
+        max_areas : int, optional
+            Return at most this many areas
+        '''
+        t = self.tile_size
+        over = self.counts > self.budget
+
+        runs = []
+        for ty, row in enumerate(over):
+            tx = 0
+            while tx < len(row):
+                if not row[tx]:
+                    tx += 1
+                    continue
+
+                start = tx
+                while tx < len(row) and row[tx]:
+                    tx += 1
+
+                worst = self.counts[ty, start:tx].max()
+                box = (
+                    start*t,
+                    ty*t,
+                    min(tx*t, self.dims[0]),
+                    min((ty+1)*t, self.dims[1])
+                )
+                runs.append((worst, box))
+
+        runs.sort(key=lambda r: r[0], reverse=True)
+        boxes = [box for _, box in runs]
+
+        if max_areas is not None:
+            boxes = boxes[:max_areas]
+
+        return boxes
@@ -0,0 +1,106 @@
+
+import json
+import os
+
+import numpy as np
+
+class FrameShadow:
+    '''
+    A copy of what was last written to the device's image buffer, kept in a
+    memory-mapped file so that it survives restarts of the program.
+
+    Pixels are stored at 4 bits per pixel (the precision the device is loaded at),
+    two per byte, so each update only touches the bytes of the area being written.
+    The file header records a fingerprint of the controller; if it does not match
+    the one given, the file is discarded and valid is False. A discarded file only
+    becomes valid again once the whole display has been written.
+
+    Parameters
+    ----------
+
+    path : str
+        The file to store the shadow in. Created if it does not exist.
+
+    dims : (int, int)
+        The dimensions of the device. The width must be even.
+
+    fingerprint : dict
+        Information identifying the device (must be JSON-serializable)
+    '''
+
+    MAGIC = b'IT8951 shadow v1\n'
+    HEADER_SIZE = 512
+
+    def __init__(self, path, dims, fingerprint):
+        if dims[0] % 2:
+            raise ValueError('width must be even')
+
+        self.path = path
+        self.dims = dims
+
+        header = self.MAGIC + json.dumps(
+            {'dims': list(dims), 'fingerprint': fingerprint},
+            sort_keys=True
+        ).encode() + b'\n'
+
+        if len(header) > self.HEADER_SIZE:
+            raise ValueError('fingerprint is too large')
+
+        self._header = header.ljust(self.HEADER_SIZE, b' ')
+        size = self.HEADER_SIZE + dims[1]*dims[0]//2
+
+        self.valid = False
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            with open(path, 'rb') as f:
+                self.valid = f.read(self.HEADER_SIZE) == self._header
+
+        if not self.valid:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+
+        self._data = np.memmap(path, dtype=np.ubyte, mode='r+', offset=self.HEADER_SIZE,
+                               shape=(dims[1], dims[0]//2))
+
+    def write(self, data, xy, dims):
+        '''
+        Record that data (1 byte per pixel, as passed to AutoDisplay.update) was
+        written to the area at xy with dimensions dims. xy[0] and dims[0] must be even.
+        '''
+        if xy[0] % 2 or dims[0] % 2:
+            raise ValueError('area must start and end on an even column')
+
+        pix = np.frombuffer(bytes(data), dtype=np.ubyte).reshape(dims[1], dims[0])
+        packed = (pix[:, ::2] & 0xF0) | (pix[:, 1::2] >> 4)
+        self._data[xy[1]:xy[1]+dims[1], xy[0]//2:(xy[0]+dims[0])//2] = packed
+        self._data.flush()
+
+        if not self.valid and tuple(xy) == (0, 0) and tuple(dims) == tuple(self.dims):
+            self._write_header(self._header)
+            self.valid = True
+
+    def read(self, box=None):
+        '''
+        Return the pixels in box (minx, miny, maxx, maxy), or the whole display if
+        box is None, as a 2D array with 1 byte per pixel. minx and maxx must be even.
+        '''
+        if box is None:
+            box = (0, 0) + tuple(self.dims)
+
+        minx, miny, maxx, maxy = box
+        packed = self._data[miny:maxy, minx//2:maxx//2]
+
+        rtn = np.empty((maxy-miny, maxx-minx), dtype=np.ubyte)
+        rtn[:, ::2] = (packed >> 4) * 0x11
+        rtn[:, 1::2] = (packed & 0x0F) * 0x11
+        return rtn
+
+    def invalidate(self):
+        '''
+        Mark the file as not matching the device, so it will not be trusted next time
+        '''
+        self.valid = False
+        self._write_header(b'\0'*self.HEADER_SIZE)
+
+    def _write_header(self, header):
+        with open(self.path, 'r+b') as f:
+            f.write(header)
@@ -1,11 +1,15 @@
 # cython: language_level=3
 # cython: profile=True
 
+cimport cython
 from cpython cimport array
 import array
+import threading
 import time
 
-cdef extern from "bcm2835.h":
+from .constants import Commands
+
+cdef extern from "bcm2835.h" nogil:
      int bcm2835_init()
      int bcm2835_close()
 
@@ -29,6 +33,74 @@ cdef extern from "bcm2835.h":
      cdef int BCM2835_SPI_MODE0
      cdef int BCM2835_SPI_CLOCK_DIVIDER_32
 
+# bcm2835 and the SPI peripheral are global to the process, so they are set up
+# by the first SPI object and shut down when the last one goes away. This lets
+# several devices on separate chip selects share the bus.
+_bus_users = 0
+
+# template for allocating read buffers with array.clone
+cdef array.array _ushort_template = array.array('H')
+
+# held for each transaction (chip select asserted to released), so that
+# objects used from different threads don't interleave on the bus
+_bus_lock = threading.RLock()
+
+# preambles, and the command code used by read_register
+cdef unsigned short _PREAMBLE_CMD = 0x6000
+cdef unsigned short _PREAMBLE_WRITE = 0x0000
+cdef unsigned short _PREAMBLE_READ = 0x1000
+cdef unsigned short _REG_RD = Commands.REG_RD
+
+# transfer helpers that don't touch Python objects, for the hot paths. They are
+# excluded from profiling, which would otherwise cost more than they do.
+
+cdef inline void _wait_hrdy(int pin_hrdy) nogil:
+    while not bcm2835_gpio_lev(pin_hrdy):
+        pass
+
+cdef inline void _send_word(unsigned short word) nogil:
+    bcm2835_spi_transfer(word>>8)
+    bcm2835_spi_transfer(word & 0xFF)
+
+cdef inline unsigned short _receive_word() nogil:
+    cdef unsigned short rtn = bcm2835_spi_transfer(0x00)<<8
+    rtn |= bcm2835_spi_transfer(0x00)
+    return rtn
+
+@cython.profile(False)
+cdef void _write_word_txn(int pin_hrdy, int pin_cs, unsigned short preamble,
+                          unsigned short word) nogil:
+    '''
+    One write transaction: preamble followed by a single word
+    '''
+    _wait_hrdy(pin_hrdy)
+    bcm2835_gpio_write(pin_cs, LOW)
+    _send_word(preamble)
+    _wait_hrdy(pin_hrdy)
+    _send_word(word)
+    bcm2835_gpio_write(pin_cs, HIGH)
+
+@cython.profile(False)
+cdef unsigned short _read_word_txn(int pin_hrdy, int pin_cs) nogil:
+    '''
+    One read transaction of a single word
+    '''
+    cdef unsigned short rtn
+
+    _wait_hrdy(pin_hrdy)
+    bcm2835_gpio_write(pin_cs, LOW)
+    _send_word(_PREAMBLE_READ)
+    _wait_hrdy(pin_hrdy)
+
+    # spec says to read two dummy bytes
+    bcm2835_spi_transfer(0)
+    bcm2835_spi_transfer(0)
+    _wait_hrdy(pin_hrdy)
+
+    rtn = _receive_word()
+    bcm2835_gpio_write(pin_cs, HIGH)
+    return rtn
+
 class SPI:
 
     # TODO move the pin numbers to a default member of the constructor
@@ -40,19 +112,26 @@ class SPI:
         pin_cs=8,
         pin_reset=17,
     ):
-        init_rtn = bcm2835_init()
-        if init_rtn != 1:
-            raise RuntimeError("Error in bcm2835_init")
+        global _bus_users
+
+        with _bus_lock:
+            if _bus_users == 0:
+                init_rtn = bcm2835_init()
+                if init_rtn != 1:
+                    raise RuntimeError("Error in bcm2835_init")
+
+                bcm2835_spi_begin();
+                bcm2835_spi_setBitOrder(BCM2835_SPI_BIT_ORDER_MSBFIRST)
+                bcm2835_spi_setDataMode(BCM2835_SPI_MODE0)
+                bcm2835_spi_setClockDivider(BCM2835_SPI_CLOCK_DIVIDER_32)
+
+            _bus_users += 1
+            self._bus_open = True
 
         self.pin_hrdy = pin_hrdy
         self.pin_cs = pin_cs
         self.pin_reset = pin_reset
 
-        bcm2835_spi_begin();
-        bcm2835_spi_setBitOrder(BCM2835_SPI_BIT_ORDER_MSBFIRST)
-        bcm2835_spi_setDataMode(BCM2835_SPI_MODE0)
-        bcm2835_spi_setClockDivider(BCM2835_SPI_CLOCK_DIVIDER_32)
-
         if self.pin_cs is not None:
             bcm2835_gpio_fsel(self.pin_cs, BCM2835_GPIO_FSEL_OUTP);
 
@@ -66,8 +145,18 @@ class SPI:
         self._write_cs(False);
 
     def __del__(self):
-        bcm2835_spi_end()
-        bcm2835_close()
+        global _bus_users
+
+        # __init__ may have failed before we registered as a user
+        if not getattr(self, '_bus_open', False):
+            return
+
+        with _bus_lock:
+            self._bus_open = False
+            _bus_users -= 1
+            if _bus_users == 0:
+                bcm2835_spi_end()
+                bcm2835_close()
 
     def reset(self):
         assert self.pin_reset is not None
@@ -93,18 +182,12 @@ class SPI:
         while not bcm2835_gpio_lev(self.pin_hrdy):
             pass
 
-    def read(self, preamble, count):
+    def _start_read(self, preamble):
         '''
-        Send preamble, and return a buffer of 16-bit unsigned ints of length count
-        containing the data received
+        Begin a read transaction: select the device, and send preamble and the
+        dummy bytes. The caller must hold _bus_lock, read the data and release
+        the chip select.
         '''
-
-        # allocate the array we will return
-        # initializing it is unnecessary here, but read() is not called
-        # with large arrays so this should not be a performance problem
-        cdef array.array rtn = array.array('H', (0,)*count)
-        cdef unsigned short[:] crtn = rtn
-
         self.wait_ready()
 
         self._write_cs(True)
@@ -120,15 +203,69 @@ class SPI:
 
         self.wait_ready()
 
-        cdef int i
-        for i in range(count):
-            crtn[i] = bcm2835_spi_transfer(0x00)<<8
-            crtn[i] |= bcm2835_spi_transfer(0x00)
+    def read_into(self, preamble, buf):
+        '''
+        Send preamble, and fill buf with the data received. buf can be any writable
+        buffer of 16-bit unsigned ints (e.g. array.array('H') or a numpy uint16
+        array); nothing is allocated, so a buffer can be reused for repeated reads.
+        '''
+        cdef unsigned short[:] cbuf = buf
+        cdef Py_ssize_t i
+
+        with _bus_lock:
+            self._start_read(preamble)
 
-        self._write_cs(False)
+            for i in range(cbuf.shape[0]):
+                cbuf[i] = bcm2835_spi_transfer(0x00)<<8
+                cbuf[i] |= bcm2835_spi_transfer(0x00)
+
+            self._write_cs(False)
 
+    def read(self, preamble, count):
+        '''
+        Send preamble, and return a buffer of 16-bit unsigned ints of length count
+        containing the data received
+        '''
+        # no need to initialize it, since it is about to be filled
+        cdef array.array rtn = array.clone(_ushort_template, count, zero=False)
+        self.read_into(preamble, rtn)
         return rtn
 
+    def _read_word(self, preamble):
+        '''
+        Send preamble, and return the single 16-bit word received
+        '''
+        cdef unsigned short rtn
+
+        with _bus_lock:
+            self._start_read(preamble)
+
+            rtn = bcm2835_spi_transfer(0x00)<<8
+            rtn |= bcm2835_spi_transfer(0x00)
+
+            self._write_cs(False)
+
+        return rtn
+
+    def _write_word(self, preamble, unsigned short word):
+        '''
+        Send preamble, and then the single 16-bit word
+        '''
+        with _bus_lock:
+            self.wait_ready()
+
+            self._write_cs(True)
+
+            bcm2835_spi_transfer(preamble>>8)
+            bcm2835_spi_transfer(preamble)
+
+            self.wait_ready()
+
+            bcm2835_spi_transfer(word>>8)
+            bcm2835_spi_transfer(word)
+
+            self._write_cs(False)
+
     def write(self, preamble, ary):
         '''
         Send preamble, and then write the data in ary (16-bit unsigned ints) over SPI
@@ -136,21 +273,22 @@ class SPI:
         cdef array.array buf = array.array('H', ary)
         cdef unsigned short[:] cbuf = buf
 
-        self.wait_ready()
+        with _bus_lock:
+            self.wait_ready()
 
-        self._write_cs(True)
+            self._write_cs(True)
 
-        bcm2835_spi_transfer(preamble>>8)
-        bcm2835_spi_transfer(preamble)
+            bcm2835_spi_transfer(preamble>>8)
+            bcm2835_spi_transfer(preamble)
 
-        self.wait_ready()
+            self.wait_ready()
 
-        # TODO: what's the best way to do this in cython?
-        for i in range(len(ary)):
-            bcm2835_spi_transfer(buf[i]>>8)
-            bcm2835_spi_transfer(buf[i])
+            # TODO: what's the best way to do this in cython?
+            for i in range(len(ary)):
+                bcm2835_spi_transfer(buf[i]>>8)
+                bcm2835_spi_transfer(buf[i])
 
-        self._write_cs(False)
+            self._write_cs(False)
 
     def write_pixels(self, pixbuf):
         '''
@@ -162,21 +300,23 @@ class SPI:
 
         cdef unsigned short preamble = 0x0000
 
+        # hold the bus for the whole image rather than taking the lock per word
         cdef int i
-        for i in range(len(cbuf)):
-            self.wait_ready()
+        with _bus_lock:
+            for i in range(len(cbuf)):
+                self.wait_ready()
 
-            self._write_cs(True)
+                self._write_cs(True)
 
-            bcm2835_spi_transfer(preamble>>8)
-            bcm2835_spi_transfer(preamble)
+                bcm2835_spi_transfer(preamble>>8)
+                bcm2835_spi_transfer(preamble)
 
-            self.wait_ready()
+                self.wait_ready()
 
-            bcm2835_spi_transfer(cbuf[i] >> 8)
-            bcm2835_spi_transfer(cbuf[i])
+                bcm2835_spi_transfer(cbuf[i] >> 8)
+                bcm2835_spi_transfer(cbuf[i])
 
-            self._write_cs(False)
+                self._write_cs(False)
 
     # the following functions are higher-level for writing and reading
     # various types of data to and from the device
@@ -194,9 +334,11 @@ class SPI:
         args : list(int), optional
             Arguments for the command
         '''
-        self.write(0x6000, [cmd])  # 0x6000 is preamble
-        for arg in args:
-            self.write_data([arg])
+        # keep the command and its arguments together on the bus
+        with _bus_lock:
+            self._write_word(0x6000, cmd)  # 0x6000 is preamble
+            for arg in args:
+                self._write_word(0x0000, arg)
 
     def write_data(self, ary):
         '''
@@ -222,8 +364,38 @@ class SPI:
         '''
         return self.read(0x1000, n)
 
+    def read_data_into(self, buf):
+        '''
+        Fill buf with 16-bit words of data from the device, without allocating
+
+        Parameters
+        ----------
+
+        buf : writable buffer of 16-bit unsigned ints
+            The buffer to fill. Its length gives the number of words read.
+        '''
+        self.read_into(0x1000, buf)
+
     def read_int(self):
         '''
         Read a single 16 bit int from the device
         '''
-        return self.read_data(1)[0]
+        return self._read_word(0x1000)
+
+    def read_register(self, unsigned short address):
+        '''
+        Read a device register. This is the fast path for polling the device's status:
+        the whole REG_RD exchange (command, address, and reading the value back) runs
+        as C, with the bus held throughout.
+        '''
+        assert self.pin_hrdy is not None and self.pin_cs is not None
+        cdef int pin_hrdy = self.pin_hrdy
+        cdef int pin_cs = self.pin_cs
+        cdef unsigned short rtn
+
+        with _bus_lock:
+            _write_word_txn(pin_hrdy, pin_cs, _PREAMBLE_CMD, _REG_RD)
+            _write_word_txn(pin_hrdy, pin_cs, _PREAMBLE_WRITE, address)
+            rtn = _read_word_txn(pin_hrdy, pin_cs)
+
+        return rtn
@@ -0,0 +1,371 @@
+
+from time import localtime, strftime
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .constants import DisplayModes
+
+class WidgetLayer:
+    '''
+    A retained-mode layer on top of an AutoDisplay. Widgets own rectangles of the
+    display's frame_buf, and only redraw the parts of them whose inputs have
+    changed. Those parts are passed directly to AutoDisplay.draw_boxes, so no
+    comparison of the whole frame is needed.
+
+    Anything drawn into frame_buf outside of the widgets is not seen by refresh();
+    use the display's draw_partial for that.
+
+    Parameters
+    ----------
+
+    display : AutoDisplay
+        The display to draw on
+    '''
+
+    def __init__(self, display):
+        self.display = display
+        self.widgets = []
+
+    def add(self, widget):
+        '''
+        Add a widget to the layer, and return it
+        '''
+        self.widgets.append(widget)
+        return widget
+
+    def refresh(self, mode=DisplayModes.DU):
+        '''
+        Redraw whatever has changed in the widgets, and update those parts of the
+        display using mode. Returns the list of boxes that were updated.
+        '''
+        boxes = []
+        for widget in self.widgets:
+            boxes += widget.draw(self.display.frame_buf)
+
+        if boxes:
+            self.display.draw_boxes(boxes, mode)
+
+        return boxes
+
+
+class Widget:
+    '''
+    Base class for widgets. A widget owns the rectangle box of the frame buffer,
+    and keeps track of which parts of it need to be redrawn. Derived classes
+    implement _render().
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int)
+        The rectangle (minx, miny, maxx, maxy) owned by the widget, in frame_buf
+        coordinates
+
+    background : int, optional
+        The gray level of the widget's background
+    '''
+
+    def __init__(self, box, background=0xFF):
+        self.box = tuple(box)
+        self.background = background
+
+        # parts of the widget that need to be redrawn, relative to the widget.
+        # start out needing a full draw
+        self._dirty = [(0, 0, self.width, self.height)]
+
+    @property
+    def width(self):
+        return self.box[2] - self.box[0]
+
+    @property
+    def height(self):
+        return self.box[3] - self.box[1]
+
+    def invalidate(self, box=None):
+        '''
+        Mark part of the widget (relative to its top-left corner), or all of it if
+        box is None, as needing to be redrawn
+        '''
+        if box is None:
+            box = (0, 0, self.width, self.height)
+
+        # clip to the widget
+        box = (
+            max(box[0], 0),
+            max(box[1], 0),
+            min(box[2], self.width),
+            min(box[3], self.height)
+        )
+
+        if box[0] < box[2] and box[1] < box[3]:
+            self._dirty.append(box)
+
+    def draw(self, frame_buf):
+        '''
+        Redraw the parts of the widget that have changed into frame_buf, and return
+        them as a list of boxes in frame_buf coordinates
+        '''
+        rtn = []
+        for box in self._dirty:
+            img = Image.new('L', (box[2]-box[0], box[3]-box[1]), self.background)
+            self._render(img, box)
+            abs_box = (
+                self.box[0]+box[0],
+                self.box[1]+box[1],
+                self.box[0]+box[2],
+                self.box[1]+box[3]
+            )
+            frame_buf.paste(img, abs_box)
+            rtn.append(abs_box)
+
+        self._dirty = []
+        return rtn
+
+    def _render(self, img, box):
+        '''
+        Draw the part box (relative to the widget) of the widget into img, which
+        has the size of box and is filled with the background
+        '''
+        raise NotImplementedError
+
+
+class GlyphCache:
+    '''
+    Rasterized glyphs, so that text can be composed without rendering it again
+    each time it changes
+    '''
+
+    def __init__(self):
+        self._glyphs = {}
+
+    def get(self, font, char):
+        '''
+        Return (mask, advance) for char in font. mask is an 'L' image with the glyph
+        drawn at the origin, and advance is the distance to the next character.
+        '''
+        key = (font, char)
+        if key not in self._glyphs:
+            advance = int(round(font.getlength(char)))
+            _, _, right, bottom = font.getbbox(char)
+            height = max(bottom, self.line_height(font))
+            mask = Image.new('L', (max(right, advance, 1), height), 0)
+            ImageDraw.Draw(mask).text((0, 0), char, fill=0xFF, font=font)
+            self._glyphs[key] = (mask, advance)
+
+        return self._glyphs[key]
+
+    @staticmethod
+    def line_height(font):
+        if hasattr(font, 'getmetrics'):
+            ascent, descent = font.getmetrics()
+            return ascent + descent
+        return font.getbbox('Ay')[3]
+
+# shared by Text widgets unless they are given their own
+_glyph_cache = GlyphCache()
+
+
+class Text(Widget):
+    '''
+    A line of text. When the text changes, only the characters that changed (and
+    any that moved as a result) are redrawn, composed from cached glyphs. Kerning
+    is not applied.
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int)
+        See Widget
+
+    text : str, optional
+        The initial text
+
+    font : PIL.ImageFont, optional
+        The font to use. Defaults to PIL's default font.
+
+    fill : int, optional
+        The gray level of the text
+
+    background : int, optional
+        See Widget
+
+    cache : GlyphCache, optional
+        Where to cache rasterized glyphs. By default, a cache shared by all Text
+        widgets is used.
+    '''
+
+    def __init__(self, box, text='', font=None, fill=0x00, background=0xFF, cache=None):
+        Widget.__init__(self, box, background=background)
+        self.font = font if font is not None else ImageFont.load_default()
+        self.fill = fill
+        self.cache = cache if cache is not None else _glyph_cache
+        self.text = text
+        self._offsets = self._layout(text)
+
+    def _layout(self, text):
+        '''
+        Return the x offset of each character of text, plus the end of the text
+        '''
+        offsets = [0]
+        for char in text:
+            offsets.append(offsets[-1] + self.cache.get(self.font, char)[1])
+        return offsets
+
+    def set_text(self, text):
+        '''
+        Change the text, marking only the characters that changed as dirty
+        '''
+        if text == self.text:
+            return
+
+        offsets = self._layout(text)
+
+        # characters that are the same and in the same place at the start and end
+        # of the old and new text don't need to be redrawn
+        start = 0
+        while (start < min(len(text), len(self.text)) and
+               text[start] == self.text[start]):
+            start += 1
+
+        old_end, new_end = len(self.text), len(text)
+        while (old_end > start and new_end > start and
+               self.text[old_end-1] == text[new_end-1] and
+               self._offsets[old_end] == offsets[new_end]):
+            old_end -= 1
+            new_end -= 1
+
+        minx = offsets[start]
+        maxx = max(self._offsets[old_end], offsets[new_end])
+
+        # glyphs can reach past their advance, both the new ones and the old ones
+        # being erased
+        maxx = self._glyph_extent(text, offsets, start, new_end, maxx)
+        maxx = self._glyph_extent(self.text, self._offsets, start, old_end, maxx)
+        self.invalidate((minx, 0, maxx, self.height))
+
+        self.text = text
+        self._offsets = offsets
+
+    def _glyph_extent(self, text, offsets, start, end, maxx):
+        '''
+        Return the right edge of the area to redraw for characters start to end
+        '''
+        for i in range(start, min(end+1, len(text))):
+            mask, _ = self.cache.get(self.font, text[i])
+            maxx = max(maxx, offsets[i] + mask.width)
+        return maxx
+
+    def _render(self, img, box):
+        for char, x in zip(self.text, self._offsets):
+            mask, advance = self.cache.get(self.font, char)
+            if x + mask.width <= box[0] or x >= box[2]:
+                continue
+            img.paste(self.fill, (x-box[0], -box[1]), mask=mask)
+
+
+class Clock(Text):
+    '''
+    Text showing the current time. Call tick() periodically; if only the seconds
+    changed, only their digits are redrawn.
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int)
+        See Widget
+
+    fmt : str, optional
+        The format of the time, as for time.strftime
+
+    Additional keyword arguments are passed to Text.
+    '''
+
+    def __init__(self, box, fmt='%H:%M:%S', **kwargs):
+        self.fmt = fmt
+        Text.__init__(self, box, text=strftime(fmt, localtime()), **kwargs)
+
+    def tick(self, t=None):
+        '''
+        Update the displayed time to t (seconds since the epoch), or to now
+        '''
+        self.set_text(strftime(self.fmt, localtime(t)))
+
+
+class ProgressBar(Widget):
+    '''
+    A horizontal bar filled in proportion to a value between 0 and 1. Only the
+    part of the bar between the old and new value is redrawn.
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int)
+        See Widget
+
+    value : float, optional
+        The initial value
+
+    fill : int, optional
+        The gray level of the filled part
+
+    background : int, optional
+        See Widget
+    '''
+
+    def __init__(self, box, value=0, fill=0x00, background=0xFF):
+        Widget.__init__(self, box, background=background)
+        self.fill = fill
+        self.value = value
+
+    def _fill_width(self, value):
+        return int(round(min(max(value, 0), 1)*self.width))
+
+    def set_value(self, value):
+        '''
+        Change the value, marking the part of the bar that changed as dirty
+        '''
+        old, new = self._fill_width(self.value), self._fill_width(value)
+        self.value = value
+        if old != new:
+            self.invalidate((min(old, new), 0, max(old, new), self.height))
+
+    def _render(self, img, box):
+        filled = self._fill_width(self.value) - box[0]
+        if filled > 0:
+            img.paste(self.fill, (0, 0, filled, img.height))
+
+
+class ImageWidget(Widget):
+    '''
+    Shows an image, redrawn whenever a different image is set
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int)
+        See Widget
+
+    image : PIL.Image, optional
+        The image to show, placed at the top-left corner of the widget
+
+    background : int, optional
+        See Widget
+    '''
+
+    def __init__(self, box, image=None, background=0xFF):
+        Widget.__init__(self, box, background=background)
+        self.image = image
+
+    def set_image(self, image):
+        '''
+        Change the image. Setting the same image object again does nothing; to
+        redraw an image that was modified in place, call invalidate().
+        '''
+        if image is self.image:
+            return
+        self.image = image
+        self.invalidate()
+
+    def _render(self, img, box):
+        if self.image is not None:
+            img.paste(self.image.convert('L'), (-box[0], -box[1]))
@@ -0,0 +1,45 @@
+/*
+ * Stand-in for the bcm2835 library's header, declaring the functions used by
+ * IT8951/spi.pyx. They are implemented in sim_bcm2835.c by simulated IT8951
+ * controllers, so that the real SPI extension can be built and run without a
+ * Raspberry Pi. See sim_bus.py.
+ */
+
+#ifndef SIM_BCM2835_H
+#define SIM_BCM2835_H
+
+#include <stdint.h>
+
+#define LOW  0x0
+#define HIGH 0x1
+
+#define BCM2835_GPIO_FSEL_INPT 0x00
+#define BCM2835_GPIO_FSEL_OUTP 0x01
+
+#define BCM2835_GPIO_PUD_OFF  0x00
+#define BCM2835_GPIO_PUD_DOWN 0x01
+#define BCM2835_GPIO_PUD_UP   0x02
+
+#define BCM2835_SPI_BIT_ORDER_LSBFIRST 0
+#define BCM2835_SPI_BIT_ORDER_MSBFIRST 1
+
+#define BCM2835_SPI_MODE0 0
+
+#define BCM2835_SPI_CLOCK_DIVIDER_32 32
+
+int bcm2835_init(void);
+int bcm2835_close(void);
+
+void bcm2835_gpio_fsel(uint8_t pin, uint8_t mode);
+void bcm2835_gpio_write(uint8_t pin, uint8_t on);
+void bcm2835_gpio_set_pud(uint8_t pin, uint8_t pud);
+uint8_t bcm2835_gpio_lev(uint8_t pin);
+
+int bcm2835_spi_begin(void);
+void bcm2835_spi_end(void);
+void bcm2835_spi_setBitOrder(uint8_t order);
+void bcm2835_spi_setDataMode(uint8_t mode);
+void bcm2835_spi_setClockDivider(uint16_t divider);
+uint8_t bcm2835_spi_transfer(uint8_t value);
+
+#endif
@@ -0,0 +1,576 @@
+/*
+ * A software implementation of the bcm2835 functions used by IT8951/spi.pyx,
+ * with simulated IT8951 controllers on the SPI bus. Each controller has its own
+ * chip select, HRDY and reset pins, and decodes the bytes sent to it while it is
+ * selected, like the real device would. Compiled together with IT8951/spi.c,
+ * this lets the actual SPI extension be exercised and timed (see sim_bus.py).
+ *
+ * Every byte transferred takes byte_time seconds (spent busy-waiting, as the
+ * real library does), and display updates keep a device busy for roughly the
+ * duration of their waveform, scaled by time_scale.
+ *
+ * The sim_* functions are for inspecting and configuring the simulation.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "bcm2835.h"
+
+#define MAX_DEVICES 16
+#define MAX_ARGS 8
+
+/* command codes and registers, as in IT8951/constants.py */
+#define CMD_SYS_RUN      0x01
+#define CMD_STANDBY      0x02
+#define CMD_SLEEP        0x03
+#define CMD_REG_RD       0x10
+#define CMD_REG_WR       0x11
+#define CMD_MEM_BST_RD_T 0x12
+#define CMD_MEM_BST_RD_S 0x13
+#define CMD_MEM_BST_END  0x15
+#define CMD_LD_IMG       0x20
+#define CMD_LD_IMG_AREA  0x21
+#define CMD_LD_IMG_END   0x22
+#define CMD_DPY_AREA     0x34
+#define CMD_GET_DEV_INFO 0x302
+#define CMD_VCOM         0x39
+
+#define REG_LUTAFSR 0x1224
+#define NUM_REGISTERS 0x2000
+
+#define PREAMBLE_CMD   0x6000
+#define PREAMBLE_WRITE 0x0000
+#define PREAMBLE_READ  0x1000
+
+#define IMG_BUF_ADDRESS 0x119F00
+
+/* rough waveform durations in seconds for a 6" panel, indexed by display mode */
+static const double waveform_times[] = {
+    2.0,   /* INIT */
+    0.26,  /* DU */
+    0.45,  /* GC16 */
+    0.45,  /* GL16 */
+    0.45,  /* GLR16 */
+    0.45,  /* GLD16 */
+    0.12,  /* A2 */
+    0.29,  /* DU4 */
+};
+#define NUM_MODES (sizeof(waveform_times)/sizeof(waveform_times[0]))
+
+struct device {
+    int pin_cs, pin_hrdy, pin_reset;
+    int selected;
+
+    int width, height;
+    uint8_t *memory;   /* one byte per pixel */
+    uint8_t *screen;   /* what the panel shows */
+    uint16_t registers[NUM_REGISTERS];
+    uint16_t vcom;
+    double busy_until;
+
+    /* the transaction in progress (since chip select was asserted) */
+    unsigned long txn_bytes;
+    uint16_t preamble;
+    uint16_t word_in;
+    uint16_t word_out;
+
+    /* the command in progress */
+    uint16_t cmd;
+    uint16_t args[MAX_ARGS];
+    int nargs;
+
+    /* data waiting to be read */
+    uint16_t *to_read;
+    size_t to_read_len, to_read_pos, to_read_cap;
+
+    /* image load in progress */
+    int loading;
+    int bpp;
+    int area[4];
+    size_t pixel_pos;
+
+    uint32_t burst_address, burst_count;
+
+    /* statistics */
+    unsigned long displays;
+    unsigned long long bytes;
+};
+
+static struct device devices[MAX_DEVICES];
+static int num_devices = 0;
+
+static int initialized = 0;
+static int spi_begun = 0;
+
+static double byte_time = 1e-6;
+static double time_scale = 1.0;
+
+static unsigned long init_calls = 0;
+static unsigned long errors = 0;
+static unsigned long conflicts = 0;
+static unsigned long long bytes_transferred = 0;
+
+static double now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec*1e-9;
+}
+
+static void spend(double t)
+{
+    double end;
+    if (t <= 0)
+        return;
+    end = now() + t;
+    while (now() < end)
+        ;
+}
+
+/* reading */
+
+static void clear_read(struct device *d)
+{
+    d->to_read_len = d->to_read_pos = 0;
+}
+
+static void queue_read(struct device *d, uint16_t word)
+{
+    if (d->to_read_len == d->to_read_cap) {
+        d->to_read_cap = d->to_read_cap ? 2*d->to_read_cap : 64;
+        d->to_read = realloc(d->to_read, d->to_read_cap*sizeof(uint16_t));
+    }
+    d->to_read[d->to_read_len++] = word;
+}
+
+static uint16_t next_read(struct device *d)
+{
+    if (d->to_read_pos >= d->to_read_len) {
+        errors++;
+        return 0;
+    }
+    return d->to_read[d->to_read_pos++];
+}
+
+static void queue_string(struct device *d, const char *s)
+{
+    /* 16 bytes, two characters per word, high byte first */
+    char buf[16] = {0};
+    int i;
+    strncpy(buf, s, sizeof(buf));
+    for (i = 0; i < 16; i += 2)
+        queue_read(d, (uint8_t)buf[i] << 8 | (uint8_t)buf[i+1]);
+}
+
+static uint16_t read_register(struct device *d, uint16_t address)
+{
+    if (address == REG_LUTAFSR)
+        return now() < d->busy_until ? 0xFFFF : 0;
+    if (address >= NUM_REGISTERS) {
+        errors++;
+        return 0;
+    }
+    return d->registers[address];
+}
+
+/* commands */
+
+static void start_load(struct device *d, uint16_t arg, int x, int y, int w, int h)
+{
+    switch ((arg >> 4) & 0x3) {
+        case 0:  d->bpp = 2; break;
+        case 3:  d->bpp = 8; break;
+        default: d->bpp = 4; break;
+    }
+    d->area[0] = x;
+    d->area[1] = y;
+    d->area[2] = w;
+    d->area[3] = h;
+    d->pixel_pos = 0;
+    d->loading = 1;
+}
+
+static void load_pixels(struct device *d, uint16_t word)
+{
+    int per_word = 16/d->bpp;
+    int mask = (1 << d->bpp) - 1;
+    int k;
+
+    for (k = 0; k < per_word; k++, d->pixel_pos++) {
+        int w = d->area[2];
+        int x, y;
+
+        if (d->pixel_pos >= (size_t)w*d->area[3])
+            return;
+
+        x = d->area[0] + d->pixel_pos % w;
+        y = d->area[1] + d->pixel_pos / w;
+        if (x < d->width && y < d->height)
+            d->memory[y*d->width + x] = ((word >> k*d->bpp) & mask)*(0xFF/mask);
+    }
+}
+
+static void display_area(struct device *d, int x, int y, int w, int h, int mode)
+{
+    int row;
+    double start;
+
+    if (mode >= (int)NUM_MODES || x+w > d->width || y+h > d->height) {
+        errors++;
+        return;
+    }
+
+    for (row = y; row < y+h; row++)
+        memcpy(d->screen + row*d->width + x, d->memory + row*d->width + x, w);
+
+    start = now() > d->busy_until ? now() : d->busy_until;
+    d->busy_until = start + waveform_times[mode]*time_scale;
+    d->displays++;
+}
+
+static void burst_read(struct device *d)
+{
+    size_t offset = d->burst_address - IMG_BUF_ADDRESS;
+    size_t size = (size_t)d->width*d->height;
+    uint32_t i;
+
+    /* memory holds one byte per pixel, row by row, two pixels per word */
+    for (i = 0; i < d->burst_count; i++, offset += 2) {
+        if (offset+1 >= size) {
+            errors++;
+            queue_read(d, 0);
+            continue;
+        }
+        queue_read(d, d->memory[offset] | d->memory[offset+1] << 8);
+    }
+}
+
+static void command(struct device *d, uint16_t cmd)
+{
+    d->cmd = cmd;
+    d->nargs = 0;
+
+    switch (cmd) {
+        case CMD_GET_DEV_INFO:
+            clear_read(d);
+            queue_read(d, d->width);
+            queue_read(d, d->height);
+            queue_read(d, IMG_BUF_ADDRESS & 0xFFFF);
+            queue_read(d, IMG_BUF_ADDRESS >> 16);
+            queue_string(d, "SIM_FW_0.1");
+            queue_string(d, "SIM_LUT_0.1");
+            break;
+
+        case CMD_MEM_BST_RD_S:
+            clear_read(d);
+            burst_read(d);
+            break;
+
+        case CMD_LD_IMG_END:
+            d->loading = 0;
+            break;
+
+        case CMD_SYS_RUN:
+        case CMD_STANDBY:
+        case CMD_SLEEP:
+        case CMD_MEM_BST_END:
+            break;
+
+        case CMD_REG_RD:
+        case CMD_REG_WR:
+        case CMD_MEM_BST_RD_T:
+        case CMD_LD_IMG:
+        case CMD_LD_IMG_AREA:
+        case CMD_DPY_AREA:
+        case CMD_VCOM:
+            /* wait for the arguments */
+            break;
+
+        default:
+            errors++;
+    }
+}
+
+static void data(struct device *d, uint16_t word)
+{
+    uint16_t *a = d->args;
+
+    if (d->loading) {
+        load_pixels(d, word);
+        return;
+    }
+
+    if (d->nargs == MAX_ARGS) {
+        errors++;
+        return;
+    }
+    a[d->nargs++] = word;
+
+    switch (d->cmd) {
+        case CMD_REG_RD:
+            if (d->nargs == 1) {
+                clear_read(d);
+                queue_read(d, read_register(d, a[0]));
+            }
+            break;
+
+        case CMD_REG_WR:
+            if (d->nargs == 2) {
+                if (a[0] < NUM_REGISTERS)
+                    d->registers[a[0]] = a[1];
+                else
+                    errors++;
+            }
+            break;
+
+        case CMD_VCOM:
+            if (d->nargs == 1 && a[0] == 0) {
+                clear_read(d);
+                queue_read(d, d->vcom);
+            }
+            else if (d->nargs == 2) {
+                d->vcom = a[1];
+            }
+            break;
+
+        case CMD_MEM_BST_RD_T:
+            if (d->nargs == 4) {
+                d->burst_address = (uint32_t)a[1] << 16 | a[0];
+                d->burst_count = (uint32_t)a[3] << 16 | a[2];
+            }
+            break;
+
+        case CMD_LD_IMG:
+            if (d->nargs == 1)
+                start_load(d, a[0], 0, 0, d->width, d->height);
+            break;
+
+        case CMD_LD_IMG_AREA:
+            if (d->nargs == 5)
+                start_load(d, a[0], a[1], a[2], a[3], a[4]);
+            break;
+
+        case CMD_DPY_AREA:
+            if (d->nargs == 5)
+                display_area(d, a[0], a[1], a[2], a[3], a[4]);
+            break;
+
+        default:
+            errors++;
+    }
+}
+
+static uint8_t device_transfer(struct device *d, uint8_t value)
+{
+    unsigned long i = d->txn_bytes++;
+    d->bytes++;
+
+    /* every transaction starts with a 16-bit preamble */
+    if (i < 2) {
+        d->preamble = i == 0 ? value << 8 : d->preamble | value;
+        return 0;
+    }
+
+    if (d->preamble == PREAMBLE_READ) {
+        /* two dummy bytes, then words, high byte first */
+        if (i < 4)
+            return 0;
+        if (i % 2 == 0) {
+            d->word_out = next_read(d);
+            return d->word_out >> 8;
+        }
+        return d->word_out & 0xFF;
+    }
+
+    if (i % 2 == 0) {
+        d->word_in = value << 8;
+        return 0;
+    }
+    d->word_in |= value;
+
+    if (d->preamble == PREAMBLE_CMD)
+        command(d, d->word_in);
+    else if (d->preamble == PREAMBLE_WRITE)
+        data(d, d->word_in);
+    else
+        errors++;
+
+    return 0;
+}
+
+static void reset_device(struct device *d)
+{
+    d->txn_bytes = 0;
+    d->cmd = 0;
+    d->nargs = 0;
+    d->loading = 0;
+    d->busy_until = 0;
+    clear_read(d);
+}
+
+/* the bcm2835 library */
+
+int bcm2835_init(void)
+{
+    init_calls++;
+    if (initialized)
+        errors++;
+    initialized = 1;
+    return 1;
+}
+
+int bcm2835_close(void)
+{
+    if (!initialized)
+        errors++;
+    initialized = 0;
+    spi_begun = 0;
+    return 1;
+}
+
+void bcm2835_gpio_fsel(uint8_t pin, uint8_t mode)
+{
+    if (!initialized)
+        errors++;
+}
+
+void bcm2835_gpio_set_pud(uint8_t pin, uint8_t pud)
+{
+    if (!initialized)
+        errors++;
+}
+
+void bcm2835_gpio_write(uint8_t pin, uint8_t on)
+{
+    int i;
+
+    if (!initialized)
+        errors++;
+
+    for (i = 0; i < num_devices; i++) {
+        struct device *d = &devices[i];
+
+        if (d->pin_cs == pin) {
+            if (on == LOW && !d->selected)
+                d->txn_bytes = 0;
+            d->selected = on == LOW;
+        }
+
+        if (d->pin_reset == pin && on == LOW)
+            reset_device(d);
+    }
+}
+
+uint8_t bcm2835_gpio_lev(uint8_t pin)
+{
+    /* the simulated devices are always ready for the next word */
+    return HIGH;
+}
+
+int bcm2835_spi_begin(void)
+{
+    if (!initialized)
+        errors++;
+    spi_begun = 1;
+    return 1;
+}
+
+void bcm2835_spi_end(void)
+{
+    if (!spi_begun)
+        errors++;
+    spi_begun = 0;
+}
+
+void bcm2835_spi_setBitOrder(uint8_t order) {}
+void bcm2835_spi_setDataMode(uint8_t mode) {}
+void bcm2835_spi_setClockDivider(uint16_t divider) {}
+
+uint8_t bcm2835_spi_transfer(uint8_t value)
+{
+    struct device *selected = NULL;
+    int i;
+
+    spend(byte_time);
+    bytes_transferred++;
+
+    if (!spi_begun) {
+        errors++;
+        return 0;
+    }
+
+    for (i = 0; i < num_devices; i++) {
+        if (!devices[i].selected)
+            continue;
+        if (selected != NULL) {
+            /* two devices driving the bus at once */
+            conflicts++;
+            return 0;
+        }
+        selected = &devices[i];
+    }
+
+    if (selected == NULL)
+        return 0;
+
+    return device_transfer(selected, value);
+}
+
+/* configuring and inspecting the simulation */
+
+void sim_reset(void)
+{
+    int i;
+    for (i = 0; i < num_devices; i++) {
+        free(devices[i].memory);
+        free(devices[i].screen);
+        free(devices[i].to_read);
+    }
+    memset(devices, 0, sizeof(devices));
+    num_devices = 0;
+
+    init_calls = errors = conflicts = 0;
+    bytes_transferred = 0;
+}
+
+void sim_set_timing(double new_byte_time, double new_time_scale)
+{
+    byte_time = new_byte_time;
+    time_scale = new_time_scale;
+}
+
+int sim_add_device(int pin_cs, int pin_hrdy, int pin_reset, int width, int height)
+{
+    struct device *d;
+
+    if (num_devices == MAX_DEVICES)
+        return -1;
+
+    d = &devices[num_devices];
+    memset(d, 0, sizeof(*d));
+    d->pin_cs = pin_cs;
+    d->pin_hrdy = pin_hrdy;
+    d->pin_reset = pin_reset;
+    d->width = width;
+    d->height = height;
+    d->vcom = 1500;
+    d->memory = malloc((size_t)width*height);
+    d->screen = malloc((size_t)width*height);
+    memset(d->memory, 0xFF, (size_t)width*height);
+    memset(d->screen, 0xFF, (size_t)width*height);
+
+    return num_devices++;
+}
+
+uint8_t *sim_memory(int dev) { return devices[dev].memory; }
+uint8_t *sim_screen(int dev) { return devices[dev].screen; }
+unsigned long sim_displays(int dev) { return devices[dev].displays; }
+unsigned long long sim_device_bytes(int dev) { return devices[dev].bytes; }
+
+int sim_initialized(void) { return initialized && spi_begun; }
+unsigned long sim_init_calls(void) { return init_calls; }
+unsigned long sim_errors(void) { return errors; }
+unsigned long sim_conflicts(void) { return conflicts; }
+unsigned long long sim_bytes(void) { return bytes_transferred; }
@@ -0,0 +1,197 @@
+'''
+This file contains SimulatedBus, which builds the real SPI extension
+(IT8951/spi.c) against a software bcm2835 library with simulated IT8951
+controllers attached (see sim_bcm2835/). Unlike SimulatedSPI, which replaces
+the SPI class entirely, this runs the actual code of spi.pyx, so its overhead is
+part of any timing, and devices on separate chip selects really share one bus.
+
+Building needs a C compiler and the Python headers. The extension is built into
+sim_bcm2835/build the first time it is needed, and rebuilt when its sources
+change.
+'''
+
+# functions and classes defined in this file
+__all__ = [
+    'SimulatedBus',
+    'SimulatedDevice',
+]
+
+import ctypes
+import importlib.util
+import os
+import subprocess
+import sysconfig
+
+import numpy as np
+
+from sys import path
+path += ['../../']
+import IT8951
+
+_sim_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim_bcm2835')
+_build_dir = os.path.join(_sim_dir, 'build')
+_spi_source = os.path.join(os.path.dirname(IT8951.__file__), 'spi.c')
+
+# the extension, and the same library loaded through ctypes to reach the sim_*
+# functions
+_module = None
+_lib = None
+
+def _build():
+    '''
+    Compile spi.c and the simulated bcm2835 library into one extension, if it is
+    out of date, and return its path
+    '''
+    ext = os.path.join(_build_dir, 'spi' + sysconfig.get_config_var('EXT_SUFFIX'))
+    sources = [_spi_source, os.path.join(_sim_dir, 'sim_bcm2835.c')]
+    deps = sources + [os.path.join(_sim_dir, 'bcm2835.h')]
+
+    if os.path.exists(ext) and os.path.getmtime(ext) > max(map(os.path.getmtime, deps)):
+        return ext
+
+    os.makedirs(_build_dir, exist_ok=True)
+    cc = (sysconfig.get_config_var('CC') or 'cc').split()
+    subprocess.check_call(cc + [
+        '-shared', '-fPIC', '-O2', '-w',
+        '-I', _sim_dir,  # our bcm2835.h, rather than the real one
+        '-I', sysconfig.get_paths()['include'],
+        '-o', ext,
+    ] + sources)
+
+    return ext
+
+def _load():
+    global _module, _lib
+
+    if _module is None:
+        ext = _build()
+
+        # loaded under its real name so that its relative imports work, but not
+        # added to sys.modules, so it doesn't stand in for a real build of IT8951.spi
+        spec = importlib.util.spec_from_file_location('IT8951.spi', ext)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        lib = ctypes.CDLL(ext)
+        lib.sim_memory.restype = ctypes.POINTER(ctypes.c_ubyte)
+        lib.sim_screen.restype = ctypes.POINTER(ctypes.c_ubyte)
+        lib.sim_set_timing.argtypes = [ctypes.c_double, ctypes.c_double]
+        for name in ('sim_displays', 'sim_init_calls', 'sim_errors', 'sim_conflicts'):
+            getattr(lib, name).restype = ctypes.c_ulong
+        for name in ('sim_device_bytes', 'sim_bytes'):
+            getattr(lib, name).restype = ctypes.c_ulonglong
+
+        _module, _lib = module, lib
+
+    return _module, _lib
+
+class SimulatedBus:
+    '''
+    The simulated SPI bus. The bcm2835 library is global to the process, so there
+    is only one bus: creating a SimulatedBus removes the devices of any earlier
+    one, which must no longer be used.
+
+    Create devices with add_device(), and SPI objects to talk to them with their
+    spi() method (or with the SPI attribute, which is the compiled SPI class).
+
+    Parameters
+    ----------
+
+    byte_time : float
+        Time in seconds to transfer one byte. The default is about what the clock
+        divider of 32 used by SPI gives.
+
+    time_scale : float
+        Factor applied to waveform times, to shorten long benchmarks
+    '''
+
+    def __init__(self, byte_time=1e-6, time_scale=1.0):
+        self.module, self._lib = _load()
+        self.SPI = self.module.SPI
+
+        self._lib.sim_reset()
+        self.set_timing(byte_time, time_scale)
+        self.devices = []
+
+    def set_timing(self, byte_time, time_scale=1.0):
+        self._lib.sim_set_timing(byte_time, time_scale)
+
+    def add_device(self, pin_cs=8, pin_hrdy=24, pin_reset=17, width=800, height=600):
+        '''
+        Attach a simulated controller to the bus, and return it
+        '''
+        index = self._lib.sim_add_device(pin_cs, pin_hrdy, pin_reset, width, height)
+        if index < 0:
+            raise RuntimeError('too many simulated devices')
+
+        device = SimulatedDevice(self, index, pin_cs, pin_hrdy, pin_reset, width, height)
+        self.devices.append(device)
+        return device
+
+    @property
+    def initialized(self):
+        '''
+        Whether the bcm2835 library and SPI peripheral are currently set up
+        '''
+        return bool(self._lib.sim_initialized())
+
+    @property
+    def init_calls(self):
+        return self._lib.sim_init_calls()
+
+    @property
+    def errors(self):
+        '''
+        The number of protocol errors and misuses of the library seen, e.g. a
+        transfer before the SPI peripheral was set up, or an invalid display mode
+        '''
+        return self._lib.sim_errors()
+
+    @property
+    def conflicts(self):
+        '''
+        The number of bytes transferred while more than one device was selected
+        '''
+        return self._lib.sim_conflicts()
+
+    @property
+    def bytes_transferred(self):
+        return self._lib.sim_bytes()
+
+class SimulatedDevice:
+    '''
+    One controller on a SimulatedBus. memory is the device's image buffer and
+    screen what the panel shows, as numpy arrays with one byte per pixel.
+    '''
+
+    def __init__(self, bus, index, pin_cs, pin_hrdy, pin_reset, width, height):
+        self.bus = bus
+        self.index = index
+        self.pin_cs = pin_cs
+        self.pin_hrdy = pin_hrdy
+        self.pin_reset = pin_reset
+        self.width = width
+        self.height = height
+
+        lib = bus._lib
+        self.memory = np.ctypeslib.as_array(lib.sim_memory(index), shape=(height, width))
+        self.screen = np.ctypeslib.as_array(lib.sim_screen(index), shape=(height, width))
+
+    def spi(self, reset=True):
+        '''
+        Return an SPI object for this device's pins. Pass reset=False for all but
+        one of several devices sharing a reset line.
+        '''
+        return self.bus.SPI(
+            pin_hrdy=self.pin_hrdy,
+            pin_cs=self.pin_cs,
+            pin_reset=self.pin_reset if reset else None,
+        )
+
+    @property
+    def displays(self):
+        return self.bus._lib.sim_displays(self.index)
+
+    @property
+    def bytes_transferred(self):
+        return self.bus._lib.sim_device_bytes(self.index)
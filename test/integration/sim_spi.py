@@ -0,0 +1,197 @@
+'''
+This file contains SimulatedSPI, a stand-in for IT8951.spi.SPI that emulates
+the controller in software. Pass it to EPD (EPD(spi=SimulatedSPI())) to
+exercise and time the higher-level code without a physical device.
+
+Transfers and waveforms take roughly as long as they would on real hardware
+(scaled by time_scale), and pixel data is kept in a simulated image buffer.
+
+Since it replaces SPI entirely, none of the code in spi.pyx runs, and each
+SimulatedSPI is its own bus. To time or test the SPI layer itself, or several
+devices sharing a bus, use SimulatedBus from sim_bus.py instead.
+'''
+
+# functions and classes defined in this file
+__all__ = [
+    'SimulatedSPI',
+]
+
+from array import array
+from time import perf_counter, sleep
+
+import numpy as np
+
+from sys import path
+path += ['../../']
+from IT8951.constants import Commands, Registers, DisplayModes, PixelModes
+
+class SimulatedSPI:
+    '''
+    Parameters
+    ----------
+
+    width, height : int
+        Dimensions of the simulated device
+
+    word_time : float
+        Time in seconds to transfer one 16-bit word, including chip select and
+        HRDY handshaking overhead
+
+    time_scale : float
+        Factor applied to waveform times, to shorten long benchmarks
+    '''
+
+    # rough waveform durations in seconds for a 6" panel
+    waveform_times = {
+        DisplayModes.INIT:  2.0,
+        DisplayModes.DU:    0.26,
+        DisplayModes.GC16:  0.45,
+        DisplayModes.GL16:  0.45,
+        DisplayModes.GLR16: 0.45,
+        DisplayModes.GLD16: 0.45,
+        DisplayModes.A2:    0.12,
+        DisplayModes.DU4:   0.29,
+    }
+
+    img_buf_address = 0x119F00
+
+    def __init__(self, width=800, height=600, word_time=4e-6, time_scale=1.0):
+        self.pin_hrdy = None
+        self.pin_cs = None
+        self.pin_reset = None
+
+        self.width = width
+        self.height = height
+        self.word_time = word_time
+        self.time_scale = time_scale
+
+        # the device's image buffer, and what is currently shown on the panel
+        self.memory = np.full((height, width), 0xFF, dtype=np.ubyte)
+        self.screen = self.memory.copy()
+
+        self.registers = {}
+        self.vcom = 1500
+        self.busy_until = 0
+
+        # statistics, for benchmarks
+        self.words_transferred = 0
+        self.transfer_time = 0
+        self.displays = 0
+
+        self._cmd = None
+        self._args = []
+        self._load_area = None
+        self._burst = None
+        self._to_read = []
+        self._debt = 0
+
+    def _spend(self, words):
+        '''
+        Account for the time taken to transfer words over the bus. Sleeps are
+        batched, since very short sleeps are not accurate.
+        '''
+        t = words*self.word_time
+        self.words_transferred += words
+        self.transfer_time += t
+        self._debt += t
+        if self._debt > 1E-3:
+            sleep(self._debt)
+            self._debt = 0
+
+    def reset(self):
+        pass
+
+    def write_cmd(self, cmd, *args):
+        self._spend(2 + len(args))
+
+        self._cmd = cmd
+        self._args = list(args)
+
+        if cmd == Commands.GET_DEV_INFO:
+            fw = np.frombuffer(b'SIM_FW_0.1'.ljust(16, b'\0'), dtype='>u2')
+            lut = np.frombuffer(b'SIM_LUT_0.1'.ljust(16, b'\0'), dtype='>u2')
+            self._to_read = [self.width, self.height,
+                             self.img_buf_address & 0xFFFF, self.img_buf_address >> 16]
+            self._to_read += list(fw) + list(lut)
+
+        elif cmd == Commands.REG_RD:
+            self._to_read = [self._read_register(args[0])]
+
+        elif cmd == Commands.VCOM:
+            if args[0] == 0:
+                self._to_read = [self.vcom]
+            else:
+                self.vcom = args[1]
+
+        elif cmd in (Commands.LD_IMG, Commands.LD_IMG_AREA):
+            pixel_format = (args[0] >> 4) & 0x3
+            if cmd == Commands.LD_IMG:
+                area = (0, 0, self.width, self.height)
+            else:
+                area = tuple(args[1:5])
+            self._load_area = (pixel_format, area)
+
+        elif cmd == Commands.LD_IMG_END:
+            self._load_area = None
+
+        elif cmd == Commands.MEM_BST_RD_T:
+            self._burst = (args[1] << 16 | args[0], args[3] << 16 | args[2])
+
+        elif cmd == Commands.MEM_BST_RD_S:
+            # memory holds one byte per pixel, row by row, two pixels per word
+            address, count = self._burst
+            offset = address - self.img_buf_address
+            words = self.memory.ravel()[offset:offset+2*count].view('<u2')
+            self._to_read = list(words)
+
+        elif cmd == Commands.DPY_AREA:
+            x, y, w, h, mode = args
+            self.screen[y:y+h, x:x+w] = self.memory[y:y+h, x:x+w]
+            start = max(perf_counter(), self.busy_until)
+            self.busy_until = start + self.waveform_times[mode]*self.time_scale
+            self.displays += 1
+
+    def _read_register(self, address):
+        if address == Registers.LUTAFSR:
+            return 0xFFFF if perf_counter() < self.busy_until else 0
+        return self.registers.get(address, 0)
+
+    def write_data(self, ary):
+        self._spend(1 + len(ary))
+        if self._cmd == Commands.REG_WR:
+            self.registers[self._args[0]] = ary[0]
+
+    def write_pixels(self, pixbuf):
+        pixbuf = np.asarray(pixbuf, dtype=np.uint16)
+
+        # every word is its own transaction, with its own preamble
+        self._spend(2*pixbuf.size)
+
+        pixel_format, (x, y, w, h) = self._load_area
+        if pixel_format == PixelModes.M_8BPP:
+            pix = pixbuf.view(np.ubyte)
+        else:
+            bpp = {PixelModes.M_2BPP: 2, PixelModes.M_3BPP: 4, PixelModes.M_4BPP: 4}[pixel_format]
+            per_word = 16 // bpp
+            shifts = np.arange(per_word, dtype=np.uint16)*bpp
+            pix = (pixbuf[:, None] >> shifts) & ((1 << bpp) - 1)
+            pix = (pix * (0xFF // ((1 << bpp) - 1))).astype(np.ubyte)
+
+        self.memory[y:y+h, x:x+w] = pix.ravel()[:w*h].reshape(h, w)
+
+    def read_data(self, n):
+        self._spend(2 + n)
+        rtn = array('H', self._to_read[:n])
+        self._to_read = self._to_read[n:]
+        return rtn
+
+    def read_data_into(self, buf):
+        buf[:] = self.read_data(len(buf))
+
+    def read_int(self):
+        return self.read_data(1)[0]
+
+    def read_register(self, address):
+        # mirrors SPI.read_register; use SimulatedBus to time the real one
+        self.write_cmd(Commands.REG_RD, address)
+        return self.read_int()
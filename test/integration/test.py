@@ -39,6 +39,7 @@ def main():
         display_gradient,
         partial_update,
         display_image_8bpp,
+        widget_update,
     ]
 
     for t in tests:
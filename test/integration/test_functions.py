@@ -14,14 +14,18 @@ __all__ = [
     'clear_display',
     'display_gradient',
     'display_image_8bpp',
-    'partial_update'
+    'partial_update',
+    'widget_update',
 ]
 
+from time import sleep
+
 from PIL import Image, ImageDraw, ImageFont
 
 from sys import path
 path += ['../../']
 from IT8951 import constants
+from IT8951.widgets import WidgetLayer, Clock, ProgressBar
 
 def print_system_info(display):
     epd = display.epd
@@ -88,6 +92,26 @@ def partial_update(display):
     _place_text(display.frame_buf, 'update', x_offset=+200)
     display.draw_partial(constants.DisplayModes.DU)
 
+def widget_update(display):
+    print('Updating widgets...')
+
+    # clear image to white
+    display.frame_buf.paste(0xFF, box=(0, 0, display.width, display.height))
+    display.draw_full(constants.DisplayModes.GC16)
+
+    font = ImageFont.truetype('/usr/share/fonts/truetype/freefont/FreeSans.ttf', 80)
+
+    layer = WidgetLayer(display)
+    clock = layer.add(Clock((50, 50, display.width-50, 150), font=font))
+    bar = layer.add(ProgressBar((50, 200, display.width-50, 240)))
+
+    # only the changed digits and the newly filled part of the bar are sent
+    for i in range(11):
+        clock.tick()
+        bar.set_value(i/10)
+        layer.refresh(constants.DisplayModes.DU)
+        sleep(1)
+
 # this function is just a helper for the others
 def _place_text(img, text, x_offset=0, y_offset=0):
     '''
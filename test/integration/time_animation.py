@@ -0,0 +1,50 @@
+'''
+Measure the frame rate reached when playing an animation with the A2 waveform,
+on the simulated controller.
+'''
+
+import argparse
+
+from PIL import Image, ImageDraw
+
+from sim_spi import SimulatedSPI
+
+from sys import path
+path += ['../../']
+from IT8951.display import AutoEPDDisplay
+from IT8951.interface import EPD
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Time animation playback')
+    p.add_argument('-f', '--fps', type=float, nargs='+', default=[5, 10, 20],
+                   help='target frame rates')
+    p.add_argument('-n', '--frames', type=int, default=50,
+                   help='number of frames to play')
+    p.add_argument('-c', '--clean-every', type=int, default=None,
+                   help='redraw the full display every this many frames')
+    return p.parse_args()
+
+def moving_box_frames(width, height, n, size=100):
+    '''
+    A square bouncing across the display
+    '''
+    for i in range(n):
+        img = Image.new('L', (width, height), 0xFF)
+        x = (i*23) % (width-size)
+        y = (i*17) % (height-size)
+        ImageDraw.Draw(img).rectangle((x, y, x+size, y+size), fill=0x00)
+        yield img
+
+def main():
+    args = parse_args()
+
+    print('target fps  achieved fps  shown  dropped  SPI utilization')
+    for fps in args.fps:
+        display = AutoEPDDisplay(epd=EPD(vcom=-2.06, spi=SimulatedSPI()))
+        frames = moving_box_frames(display.width, display.height, args.frames)
+        r = display.play(frames, fps=fps, clean_every=args.clean_every)
+        print('{:10.1f}  {:12.1f}  {:5d}  {:7d}  {:14.0%}'.format(
+            fps, r['fps'], r['shown'], r['dropped'], r['spi_utilization']))
+
+if __name__ == '__main__':
+    main()
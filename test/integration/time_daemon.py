@@ -0,0 +1,123 @@
+'''
+Measure submit latency and aggregate update rate of the display daemon, with
+several client processes sharing a simulated display. The time runs until the
+server has drawn every submitted update, and the simulated panel is then checked
+against what the clients drew.
+'''
+
+import argparse
+import os
+import tempfile
+import threading
+from multiprocessing import Process, Queue
+from time import perf_counter
+
+import numpy as np
+from PIL import ImageDraw
+
+from sim_spi import SimulatedSPI
+
+from sys import path
+path += ['../../']
+from IT8951 import constants
+from IT8951.daemon import DisplayServer, DisplayClient
+from IT8951.display import AutoEPDDisplay
+from IT8951.interface import EPD
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Time updates through the display daemon')
+    p.add_argument('-c', '--clients', type=int, nargs='+', default=[1, 2, 4],
+                   help='numbers of clients to run')
+    p.add_argument('-u', '--updates', type=int, default=20,
+                   help='number of updates each client submits')
+    return p.parse_args()
+
+def run_client(socket_path, box, updates, results):
+    client = DisplayClient(box, socket_path=socket_path)
+    draw = ImageDraw.Draw(client.frame_buf)
+
+    latencies = []
+    for i in range(updates):
+        bar = (0, 0, client.width, 20)
+        draw.rectangle(bar, fill=0xFF)
+        draw.rectangle((0, 0, (i*37) % client.width, 20), fill=0x00)
+
+        start = perf_counter()
+        client.update(constants.DisplayModes.DU, boxes=[bar])
+        latencies.append(perf_counter()-start)
+
+    client.close()
+    results.put(latencies)
+
+def serve_until_idle(server, submitted, stats):
+    '''
+    Serve requests until all clients have submitted their updates and the server
+    has drawn them all, recording when that happened in stats. Only this thread
+    talks to the display.
+    '''
+    while not (submitted.is_set() and server.idle()):
+        server.serve_once(server.poll_interval)
+    stats['end'] = perf_counter()
+
+def time_clients(n, updates):
+    spi = SimulatedSPI()
+    display = AutoEPDDisplay(epd=EPD(vcom=-2.06, spi=spi))
+    display.draw_full(constants.DisplayModes.GC16)
+    display.epd.wait_display_ready()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'it8951.sock')
+    server = DisplayServer(display, socket_path=socket_path, idle_timeout=0.1)
+
+    # one horizontal strip of the display per client
+    strip = display.height // n
+    results = Queue()
+    clients = [
+        Process(target=run_client,
+                args=(socket_path, (0, i*strip, display.width, (i+1)*strip), updates, results))
+        for i in range(n)
+    ]
+
+    displays = spi.displays
+    submitted = threading.Event()
+    stats = {}
+    thread = threading.Thread(target=serve_until_idle, args=(server, submitted, stats))
+
+    start = perf_counter()
+    thread.start()
+    for c in clients:
+        c.start()
+    latencies = []
+    for c in clients:
+        latencies += results.get()
+    for c in clients:
+        c.join()
+    submitted.set()
+    thread.join()
+    elapsed = stats['end'] - start
+
+    server.close()
+
+    # every update should have reached the panel
+    expected = np.asarray(display.frame_buf) >> 4
+    if not np.array_equal(spi.screen >> 4, expected):
+        raise RuntimeError('the display does not show what the clients submitted')
+
+    latencies.sort()
+    return {
+        'median_ms': 1000*latencies[len(latencies)//2],
+        'p95_ms': 1000*latencies[int(len(latencies)*0.95)],
+        'submits_per_s': n*updates/elapsed,
+        'displays_per_s': (spi.displays-displays)/elapsed,
+    }
+
+def main():
+    args = parse_args()
+
+    print('clients  median latency (ms)  p95 latency (ms)  submits/s  display updates/s')
+    for n in args.clients:
+        r = time_clients(n, args.updates)
+        print('{:7d}  {:19.2f}  {:16.2f}  {:9.1f}  {:17.1f}'.format(
+            n, r['median_ms'], r['p95_ms'], r['submits_per_s'], r['displays_per_s']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''
+Compare several panels sharing one simulated SPI bus (see sim_bus.py) driven as
+one MultiEPDDisplay, with the same panels driven as separate AutoEPDDisplays
+updated one after the other.
+
+All panels go through the real SPI extension, so their transfers serialize on
+the bus, and any bus errors or chip select conflicts are reported.
+
+Two workloads are timed:
+
+ - even: each round, a bar changes on every panel. Both ways of driving the
+   panels overlap one panel's waveform with transfers to the others, so their
+   throughput is about the same.
+
+ - busy: each round, the first panel also gets a slow GC16 update first. Both
+   are then limited by that panel, but MultiEPDDisplay loads the other panels
+   while it is busy instead of waiting behind it. The delay from the start of
+   each round's DU update until the other panels start displaying is reported.
+'''
+
+import argparse
+from time import perf_counter
+
+from PIL import ImageDraw
+
+from sim_bus import SimulatedBus
+
+from sys import path
+path += ['../../']
+from IT8951 import constants
+from IT8951.interface import EPD
+from IT8951.display import AutoEPDDisplay, MultiEPDDisplay
+
+# chip select and HRDY pins for each panel
+PINS = [(8, 24), (7, 25), (5, 23), (6, 22)]
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Time multi-panel updates')
+    p.add_argument('-n', '--panels', type=int, nargs='+', default=[1, 2, 4],
+                   help='numbers of panels to simulate')
+    p.add_argument('-u', '--updates', type=int, default=10,
+                   help='number of updates to time')
+    return p.parse_args()
+
+class TimedEPD(EPD):
+    '''
+    An EPD recording when each display update is started
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.started = []
+        EPD.__init__(self, *args, **kwargs)
+
+    def display_area(self, xy, dims, display_mode):
+        self.started.append(perf_counter())
+        EPD.display_area(self, xy, dims, display_mode)
+
+def make_epds(n):
+    '''
+    Return a new bus, and n EPDs on it sharing one reset line
+    '''
+    if n > len(PINS):
+        raise ValueError('at most {} panels'.format(len(PINS)))
+
+    bus = SimulatedBus()
+    epds = []
+    for i, (cs, hrdy) in enumerate(PINS[:n]):
+        device = bus.add_device(pin_cs=cs, pin_hrdy=hrdy)
+        epds.append(TimedEPD(vcom=-2.06, spi=device.spi(reset=(i == 0))))
+    return bus, epds
+
+def draw_bar(frame_buf, x, i):
+    '''
+    Draw a bar at x offset x, changing with i
+    '''
+    draw = ImageDraw.Draw(frame_buf)
+    draw.rectangle((x+100, 100, x+500, 300), fill=0xFF)
+    draw.rectangle((x+100, 100, x+100+(i*40)%400, 300), fill=0x00)
+
+def draw_header(frame_buf, i):
+    '''
+    Change the shade of a header near the top-left corner
+    '''
+    ImageDraw.Draw(frame_buf).rectangle((0, 0, 400, 60), fill=(i*40) % 0x100)
+
+def check_bus(bus):
+    # the panels' SPI objects should have set up the bus only once between them
+    if bus.errors or bus.conflicts or bus.init_calls > 1:
+        raise RuntimeError('bus misused: {} errors, {} conflicts, {} inits'.format(
+            bus.errors, bus.conflicts, bus.init_calls))
+
+def time_updates(n, updates, multi, busy):
+    '''
+    Return (updates per second, mean delay in seconds before panels other than the
+    first started each round's DU update)
+    '''
+    bus, epds = make_epds(n)
+    if multi:
+        display = MultiEPDDisplay(epds)
+        displays = [display]
+    else:
+        displays = [AutoEPDDisplay(epd=epd) for epd in epds]
+
+    for display in displays:
+        display.draw_full(constants.DisplayModes.GC16)
+    for epd in epds:
+        epd.wait_display_ready()
+
+    delays = []
+    start = perf_counter()
+    for i in range(updates):
+        if busy:
+            draw_header(displays[0].frame_buf, i)
+            displays[0].draw_partial(constants.DisplayModes.GC16)
+
+        round_start = perf_counter()
+        if multi:
+            for x, _ in display.offsets:
+                draw_bar(display.frame_buf, x, i)
+            display.draw_partial(constants.DisplayModes.DU)
+        else:
+            for display in displays:
+                draw_bar(display.frame_buf, 0, i)
+                display.draw_partial(constants.DisplayModes.DU)
+
+        delays += [epd.started[-1]-round_start for epd in epds[1:]]
+
+    for epd in epds:
+        epd.wait_display_ready()
+    elapsed = perf_counter()-start
+
+    check_bus(bus)
+    return n*updates/elapsed, sum(delays)/len(delays) if delays else 0
+
+def main():
+    args = parse_args()
+
+    for busy in (False, True):
+        print('{} workload'.format('busy' if busy else 'even'))
+        print('panels  separate (updates/s)  multi (updates/s)  '
+              'separate delay (ms)  multi delay (ms)')
+        for n in args.panels:
+            separate, separate_delay = time_updates(n, args.updates, False, busy)
+            multi, multi_delay = time_updates(n, args.updates, True, busy)
+            print('{:6d}  {:20.2f}  {:17.2f}  {:19.0f}  {:16.0f}'.format(
+                n, separate, multi, 1000*separate_delay, 1000*multi_delay))
+        print()
+
+if __name__ == '__main__':
+    main()
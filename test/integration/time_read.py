@@ -0,0 +1,72 @@
+'''
+Measure how fast the device's status can be polled, and how fast image memory
+can be read back. Runs the real SPI extension against simulated controllers
+(see sim_bus.py) unless --device is given.
+'''
+
+import argparse
+from time import perf_counter
+
+from sys import path
+path += ['../../']
+from IT8951.constants import Commands, Registers
+from IT8951.interface import EPD
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Time register polling and memory reads')
+    p.add_argument('-d', '--device', action='store_true',
+                   help='use the physical device instead of the simulated one')
+    p.add_argument('-t', '--time', type=float, default=2,
+                   help='number of seconds to run each test for')
+    p.add_argument('-b', '--byte-time', type=float, nargs='+', default=[0, 1e-6],
+                   help='simulated time to transfer one byte, in seconds. With 0, '
+                        'only the time spent in the host code is measured.')
+    return p.parse_args()
+
+def rate(f, duration):
+    '''
+    Call f repeatedly for duration seconds, and return the calls per second
+    '''
+    n = 0
+    start = perf_counter()
+    while perf_counter() - start < duration:
+        f()
+        n += 1
+    return n/(perf_counter()-start)
+
+def time_epd(epd, duration):
+    def poll_generic():
+        # the exchange read_register used to go through: generic writes of the
+        # command and address, and a read into an allocated buffer
+        epd.spi.write(0x6000, [Commands.REG_RD])
+        epd.spi.write(0x0000, [Registers.LUTAFSR])
+        return epd.spi.read(0x1000, 1)[0]
+
+    print('register polls/s, generic read:  {:.0f}'.format(rate(poll_generic, duration)))
+    print('register polls/s, read_register: {:.0f}'.format(rate(epd.display_ready, duration)))
+
+    for dims in [(16, 16), (epd.width, 64)]:
+        reads = rate(lambda: epd.read_img_area((0, 0), dims), duration)
+        print('memory read-back of {}x{}: {:.1f} reads/s, {:.0f} pixels/s'.format(
+            dims[0], dims[1], reads, reads*dims[0]*dims[1]))
+
+def main():
+    args = parse_args()
+
+    if args.device:
+        time_epd(EPD(vcom=-2.06), args.time)
+        return
+
+    from sim_bus import SimulatedBus
+
+    bus = SimulatedBus()
+    epd = EPD(vcom=-2.06, spi=bus.add_device().spi())
+
+    for byte_time in args.byte_time:
+        bus.set_timing(byte_time)
+        print('simulated byte time: {:g} s'.format(byte_time))
+        time_epd(epd, args.time)
+        print()
+
+if __name__ == '__main__':
+    main()